@@ -6,6 +6,8 @@ It currently contains:
     - neuro_data module(nd): Gives a user of python access to Neuroverse Data Stores
 """
 
+import os
+
 debug_val=False
 
 def home_directory():
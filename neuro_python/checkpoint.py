@@ -0,0 +1,59 @@
+"""
+Local checkpoint files recording the completed parts of bulk operations so they can be resumed
+"""
+
+import os
+import json
+import datetime
+import threading
+
+_lock = threading.Lock()
+
+def load_checkpoint(file_name: str):
+    """
+    Load the completed parts recorded in a checkpoint file. Returns an empty checkpoint if the file doesn't exist.
+    """
+    if file_name is None or not os.path.isfile(file_name):
+        return {"Completed" : {}}
+    with _lock:
+        with open(file_name) as file:
+            return json.loads(file.read())
+
+def start_checkpoint(file_name: str, resume: bool):
+    """
+    Get the completed parts to skip. Unless resuming, any existing checkpoint is discarded.
+    """
+    if file_name is None:
+        return {}
+    if not resume:
+        save_checkpoint(file_name, {"Completed" : {}})
+    return load_checkpoint(file_name)["Completed"]
+
+def save_checkpoint(file_name: str, checkpoint: dict):
+    """
+    Write a checkpoint file. The file is replaced atomically so a crash never leaves a partial checkpoint.
+    """
+    with _lock:
+        _write(file_name, checkpoint)
+
+def mark_completed(file_name: str, key: str, result: dict):
+    """
+    Record that a part of a bulk operation completed with the JobId and TimeStamp in result
+    """
+    if file_name is None:
+        return
+    with _lock:
+        checkpoint = {"Completed" : {}}
+        if os.path.isfile(file_name):
+            with open(file_name) as file:
+                checkpoint = json.loads(file.read())
+        entry = dict(result or {})
+        entry["CompletedAt"] = datetime.datetime.utcnow().isoformat()
+        checkpoint["Completed"][key] = entry
+        _write(file_name, checkpoint)
+
+def _write(file_name: str, checkpoint: dict):
+    tmp_file_name = file_name + ".tmp"
+    with open(tmp_file_name, "w") as file:
+        file.write(json.dumps(checkpoint, default=str))
+    os.replace(tmp_file_name, file_name)
@@ -0,0 +1,110 @@
+"""
+Run a set of dependent tasks concurrently
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+def topological_order(dependencies: "Dict[str, List[str]]"):
+    """
+    Order task names so that every task comes after its dependencies
+    """
+    for name, deps in dependencies.items():
+        for dep in deps:
+            if dep not in dependencies:
+                raise Exception("%s depends on unknown task %s"%(name, dep))
+    order = []
+    state = {}
+    def visit(name, path):
+        if state.get(name) == 2:
+            return
+        if state.get(name) == 1:
+            raise Exception("Dependency cycle: " + " -> ".join(path + [name]))
+        state[name] = 1
+        for dep in dependencies[name]:
+            visit(dep, path + [name])
+        state[name] = 2
+        order.append(name)
+    for name in dependencies:
+        visit(name, [])
+    return order
+
+def run_dag(tasks: "Dict[str, Callable]", dependencies: "Dict[str, List[str]]", max_workers: int = 4,
+            completed: "Dict[str, dict]" = None, retries: int = 0):
+    """
+    Run tasks concurrently, starting each one as soon as all of its dependencies have succeeded.
+    Each task is called with a dict of its dependencies' results.
+    completed: results of tasks that already succeeded, these tasks are not run again.
+    retries: number of times a failed task is retried before its dependants are skipped.
+    Returns a dict of task name to {"Status", "Result", "Error", "Start", "End", "Seconds", "Attempts"}
+    where Status is Succeeded, Failed or Skipped.
+    """
+    topological_order(dependencies)
+    results = dict(completed or {})
+    pending = [name for name in dependencies if name not in results or results[name]["Status"] != "Succeeded"]
+    for name in pending:
+        results.pop(name, None)
+    attempts = {name : 0 for name in pending}
+    running = {}
+
+    def run_task(name):
+        start = time.time()
+        inputs = {dep : results[dep]["Result"] for dep in dependencies[name]}
+        try:
+            result = tasks[name](inputs)
+            error = None
+        except Exception as err:
+            result = None
+            error = str(err)
+        end = time.time()
+        return {"Status" : "Succeeded" if error is None else "Failed", "Result" : result, "Error" : error,
+                "Start" : start, "End" : end, "Seconds" : end - start}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for name in list(pending):
+                dep_status = [results[dep]["Status"] if dep in results else None for dep in dependencies[name]]
+                if any(status in ["Failed", "Skipped"] for status in dep_status):
+                    pending.remove(name)
+                    results[name] = {"Status" : "Skipped", "Result" : None, "Error" : "Dependency did not succeed",
+                                     "Start" : None, "End" : None, "Seconds" : 0.0, "Attempts" : 0}
+                elif all(status == "Succeeded" for status in dep_status):
+                    pending.remove(name)
+                    attempts[name] += 1
+                    running[executor.submit(run_task, name)] = name
+            if len(running) == 0:
+                continue
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                result = future.result()
+                result["Attempts"] = attempts[name]
+                if result["Status"] == "Failed" and attempts[name] <= retries:
+                    pending.append(name)
+                else:
+                    results[name] = result
+    return results
+
+def critical_path(dependencies: "Dict[str, List[str]]", seconds: "Dict[str, float]"):
+    """
+    The chain of dependent tasks with the longest total duration.
+    Returns the task names in the chain and the total seconds.
+    """
+    finish = {}
+    previous = {}
+    for name in topological_order(dependencies):
+        longest = None
+        for dep in dependencies[name]:
+            if longest is None or finish[dep] > finish[longest]:
+                longest = dep
+        previous[name] = longest
+        finish[name] = (finish[longest] if longest is not None else 0.0) + (seconds.get(name) or 0.0)
+    if len(finish) == 0:
+        return [], 0.0
+    name = max(finish, key=lambda x: finish[x])
+    total = finish[name]
+    path = []
+    while name is not None:
+        path.insert(0, name)
+        name = previous[name]
+    return path, total
@@ -1,5 +1,7 @@
 """
 The neuro_compute module contains:
     spark_manager(sm): Creates, runs and schedules spark jobs
+    remote_dataframe(rd): Lazy proxy for dataframes in interactive spark contexts
 """
 from neuro_python.neuro_compute import spark_manager as spm
+from neuro_python.neuro_compute import remote_dataframe as rd
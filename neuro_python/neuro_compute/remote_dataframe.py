@@ -0,0 +1,124 @@
+"""
+Lazy proxy for a spark dataframe in an interactive spark context
+"""
+
+import uuid
+from neuro_python.neuro_compute import spark_manager as spm
+
+#Expressions are sent inline in other commands so pyspark.sql.functions.expr is imported in the expression
+_SQL_EXPR = "__import__('pyspark.sql.functions', fromlist=['expr']).expr"
+
+def _check_script(script: str):
+    """
+    Check a generated pyspark script compiles so syntax errors are raised before it is sent to a context
+    """
+    compile(script, "<remote_dataframe>", "exec")
+    return script
+
+class RemoteDataFrame:
+    """
+    A spark dataframe in an interactive spark context.
+    select, filter, groupBy, join and limit are recorded locally and return a new RemoteDataFrame. A pyspark
+    command is only sent to the context when head, count, to_pandas, persist or export_table is called.
+    dataframe_name: a dataframe variable in the context, or any pyspark expression returning a dataframe.
+    """
+    def __init__(self, dataframe_name: str, context: str = None, operations: "List[str]" = None):
+        self.dataframe_name = dataframe_name
+        self.context = spm.context_id if context is None else context
+        self.operations = list(operations or [])
+
+    @classmethod
+    def from_sql(cls, sql: str, context: str = None):
+        """
+        A RemoteDataFrame for the result of a spark sql query
+        """
+        return cls("spark.sql(%r)"%sql, context)
+
+    def _with(self, operation: str):
+        return RemoteDataFrame(self.dataframe_name, self.context, self.operations + [operation])
+
+    def expression(self):
+        """
+        The pyspark expression of the dataframe with all the recorded operations
+        """
+        return self.dataframe_name + "".join(self.operations)
+
+    def select(self, *columns: str):
+        return self._with(".select(%s)"%", ".join([repr(col) for col in columns]))
+
+    def filter(self, condition: str):
+        """
+        Keep the rows matching a spark sql condition eg. "Value > 10 and Year = 2019"
+        """
+        return self._with(".filter(%r)"%condition)
+
+    where = filter
+
+    def groupBy(self, *columns: str):
+        return GroupedRemoteDataFrame(self, columns)
+
+    def join(self, other: "RemoteDataFrame", on: "Union[str, List[str]]", how: str = "inner"):
+        if other.context != self.context:
+            raise Exception("Only dataframes in the same context can be joined")
+        return self._with(".join(%s, on=%r, how=%r)"%(other.expression(), on, how))
+
+    def limit(self, n: int):
+        return self._with(".limit(%s)"%int(n))
+
+    def head(self, n: int = 5):
+        """
+        The first n rows as a pandas dataframe
+        """
+        return self.to_pandas(limit=n)
+
+    def to_pandas(self, limit: int = None, columns: "List[str]" = None):
+        """
+        Move the dataframe into a pandas dataframe, see spark_manager.spark_to_pandas
+        """
+        return spm.spark_to_pandas(_check_script(self.expression()), columns=columns, limit=limit,
+                                   context=self.context)
+
+    def count(self):
+        return int(spm.run_command(self.context, _check_script("print(%s.count())"%self.expression())).strip())
+
+    def persist(self, dataframe_name: str = None):
+        """
+        Evaluate the recorded operations into a dataframe variable in the context and return a RemoteDataFrame for it
+        """
+        dataframe_name = dataframe_name or "rdf_" + uuid.uuid4().hex
+        spm.run_command(self.context, _check_script("%s = %s"%(dataframe_name, self.expression())))
+        return RemoteDataFrame(dataframe_name, self.context)
+
+    def export_table(self, data_store_name: str, table_name: str, partition_path: str = "'/'",
+                     write_mode: str = "append"):
+        """
+        Export the dataframe into a Neuroverse datalake table, see spark_manager.export_table
+        """
+        remote = self if len(self.operations) == 0 and self.dataframe_name.isidentifier() else self.persist()
+        table = spm.export_table(remote.dataframe_name, data_store_name, table_name, partition_path, write_mode)
+        command = spm.execute_export_table_command(self.context, table)
+        spm.command_output(spm.wait_for_command(command['CommandId'], self.context))
+
+    def __repr__(self):
+        return "RemoteDataFrame(%s)"%self.expression()
+
+class GroupedRemoteDataFrame:
+    """
+    A grouped RemoteDataFrame, call agg or count to get a RemoteDataFrame back
+    """
+    def __init__(self, remote: RemoteDataFrame, columns: "List[str]"):
+        self.remote = remote
+        self.columns = columns
+
+    def _group_by(self):
+        return ".groupBy(%s)"%", ".join([repr(col) for col in self.columns])
+
+    def agg(self, *expressions: str):
+        """
+        Aggregate with spark sql expressions eg. agg("sum(Value) as Total", "max(Date) as Latest")
+        """
+        aggregates = ", ".join([_SQL_EXPR + "(%r)"%expr for expr in expressions])
+        return self.remote._with(self._group_by() + ".agg(%s)"%aggregates)
+
+    def count(self):
+        return self.remote._with(self._group_by() + ".count()")
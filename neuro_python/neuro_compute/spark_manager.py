@@ -4,17 +4,24 @@ Spark Manager in Neuroverse.
 """
 
 from neuro_python.neuro_call import neuro_call
+from neuro_python.temp_storage import temp_file
 import uuid
 import os
+import json
+import base64
 import datetime
 import pandas as pd
 pd.set_option('display.max_rows', None)
+import pyarrow
 import time
 import threading
 from IPython.display import display,HTML,TextDisplayObject
 import ipywidgets as widgets
 from typing import Union, Tuple
 from functools import singledispatch
+from neuro_python import dag
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 
 from IPython.core import magic_arguments
@@ -23,6 +30,26 @@ from IPython.core.magic import line_magic, cell_magic, line_cell_magic, Magics,
 #Default context id
 context_id=''
 
+#Cluster and workspace listings are reused for this many seconds by the status and look up functions
+CLUSTER_CACHE_SECONDS=5
+_listings={}
+_listings_lock=threading.Lock()
+
+def _cached_listing(key, max_age: float, fetch):
+    with _listings_lock:
+        entry = _listings.get(key)
+        if entry is None or time.time() - entry[0] >= max_age:
+            entry = (time.time(), fetch())
+            _listings[key] = entry
+    return [dict(item) for item in entry[1]]
+
+def clear_cluster_cache():
+    """
+    Forget the cached cluster and workspace listings
+    """
+    with _listings_lock:
+        _listings.clear()
+
 def script_parameter(name: str, value):
     """
     Cmd line parameter value to be used in the pyspark script. eg sys.argv[1]
@@ -151,51 +178,55 @@ def list_runs(job_id: str, schedule_id: str = None, submitted_by: str = None, ma
                                    )
     return list_runs_response["RunSummaries"]
 
+def _inspect_run(key: Tuple[str, str]):
+    job_id, run_id = key
+    func_run_info = next((run_json for run_json in list_runs(job_id, run_id=run_id)
+                          if run_json["RunId"]==run_id),
+                          None)
+    if func_run_info is None:
+        raise Exception("Unable to find RunId in run history.")
+    if func_run_info['Status'].lower() not in ['running', 'failed', 'finished']:
+        raise ValueError(f"Run status {func_run_info['Status']} not in expected subset: Running, Failed, Finished.")
+    return func_run_info
+
+_run_poller = None
+
+def get_run_poller():
+    """
+    The shared poller of job runs, runs are tracked by (JobId, RunId) and looked up by RunId
+    """
+    global _run_poller
+    with _pollers_lock:
+        if _run_poller is None:
+            _run_poller = StatusPoller(_inspect_run, ['failed', 'finished'], lambda key: cancel_run(key[1]),
+                                       min_interval=3.0, max_interval=30.0)
+        return _run_poller
+
 def _run_job_wrapper(job_id: str, run_name: str) -> Tuple[bool, str]:
     run_metadata = run_job(job_id=job_id, run_name=run_name)
     time.sleep(1)
     if run_metadata['ErrorCode']==0:
-        while 1:
-            runs_info = list_runs(job_id)
-            func_run_info = next((run_json for run_json in runs_info
-                                if run_json["RunId"]==run_metadata['RunId']),
-                                None)
-            if func_run_info is None:
-                return False, "Unable to find RunId in run history."
-            run_status = func_run_info['Status'].lower()
-            if run_status=='running':
-                time.sleep(3)
-            elif run_status=='failed':
-                return False, func_run_info['Message']
-            elif run_status=='finished':
-                return True, 'Success'
-            else:
-                raise ValueError(f"Run status {func_run_info['Status']} not in expected subset: Running, Failed, Finished.")
+        try:
+            func_run_info = get_run_poller().track((job_id, run_metadata['RunId'])).result()
+        except ValueError:
+            raise
+        except Exception as err:
+            return False, str(err)
+        if func_run_info is None:
+            return False, "Run cancelled"
+        if func_run_info['Status'].lower()=='failed':
+            return False, func_run_info['Message']
+        return True, 'Success'
     else:
         return False, run_metadata['Error']
 
-@singledispatch
-def run_manual_job(job_name, cluster_id: str = None, workspace_id: str = None, run_name:str = None) -> Tuple[bool, str]:
+def _match_job(job_name: str, available_jobs: "List[dict]"):
     """
-    Run either one job, or, if a list is provided, a sequence of jobs. This job_name will be a look_up string or substring
-    for a job on Neuroverse, this job(s) is found in the job directory and then a run is generated with the run_name provided
-    (if run_name==None then a random run_name is generated).
-    This function is recursive and will accept nested lists, so long the final non-list elements are strings.
-    NOTE: This function should be used with caution as it will trigger live jobs, only use look-up job names which you are confident will
-    hit your intended target.
+    Find the job a job name look up string refers to.
+    Returns the job and a message to show, or None and the error message.
     """
-    raise ValueError(f"job_name must be str or list, got {type(job_name)}")
-
-@run_manual_job.register(str)
-def _(job_name:str, cluster_id=None, workspace_id=None, run_name=None):
-    available_jobs = list_jobs(workspace_id=workspace_id, cluster_id=cluster_id)
     valid_jobs = []
     extact_matchs = []
-    if run_name is None:
-        run_name_tmp = f"{job_name}_manual_{datetime.datetime.utcnow()}"
-    else:
-        run_name_tmp = run_name
-    
     # search all jobs on cluster for those matching or including given job name
     for job_i in available_jobs:
         if job_name==job_i["JobName"]:
@@ -205,34 +236,52 @@ def _(job_name:str, cluster_id=None, workspace_id=None, run_name=None):
             valid_jobs.append(job_i)
         else:
             pass
-    
-    # check the valid_jobs and begin job if 1 otherwise return warning
+
+    # check the valid_jobs and return the job if 1 otherwise return warning
     if len(valid_jobs)==0:
-        error_msg = f'No jobs found on cluster containing {job_name}, confirm cluster and job list.'
-        print(error_msg)
-        return False, error_msg
+        return None, f'No jobs found on cluster containing {job_name}, confirm cluster and job list.'
     elif len(valid_jobs)>1:
         if len(extact_matchs)==1:
-            print(f'Multiple jobs found with given {job_name} substring, however one job had exact \
+            return extact_matchs[0], f'Multiple jobs found with given {job_name} substring, however one job had exact \
                   job name and so will run this job'
-                 )
-            return _run_job_wrapper(job_id=extact_matchs[0]['JobId'], run_name=run_name_tmp)        
         elif len(extact_matchs)>1:
-            error_msg = f'Multiple jobs found with exact job name provided, {job_name}, please review jobs \
+            return None, f'Multiple jobs found with exact job name provided, {job_name}, please review jobs \
                   on cluster and remove duplicate jobs before using this function'
-            print(error_msg)
-            return False, error_msg
         else:
-            error_msg = f'The {job_name} arg had multiple options, please review jobs \
+            return None, f'The {job_name} arg had multiple options, please review jobs \
                   and either remove duplicate jobs or use an exact name for job_name arg.'
-            print(error_msg)
-            return False, error_msg            
     elif len(valid_jobs)==1:
-        print(f"Commencing job: {valid_jobs[0]['JobName']}")
-        return _run_job_wrapper(job_id=valid_jobs[0]['JobId'], run_name=run_name_tmp)
+        return valid_jobs[0], f"Commencing job: {valid_jobs[0]['JobName']}"
     else:
         raise IndexError(f'valid_jobs has an accountable length: {len(valid_jobs)}')
 
+@singledispatch
+def run_manual_job(job_name, cluster_id: str = None, workspace_id: str = None, run_name:str = None) -> Tuple[bool, str]:
+    """
+    Run either one job, or, if a list is provided, a sequence of jobs, or, if a dict of job names to the job names they
+    depend on is provided, a dependency graph of jobs through run_job_dag. This job_name will be a look_up string or substring
+    for a job on Neuroverse, this job(s) is found in the job directory and then a run is generated with the run_name provided
+    (if run_name==None then a random run_name is generated).
+    This function is recursive and will accept nested lists, so long the final non-list elements are strings.
+    NOTE: This function should be used with caution as it will trigger live jobs, only use look-up job names which you are confident will
+    hit your intended target.
+    """
+    raise ValueError(f"job_name must be str or list, got {type(job_name)}")
+
+@run_manual_job.register(str)
+def _(job_name:str, cluster_id=None, workspace_id=None, run_name=None):
+    available_jobs = list_jobs(workspace_id=workspace_id, cluster_id=cluster_id)
+    if run_name is None:
+        run_name_tmp = f"{job_name}_manual_{datetime.datetime.utcnow()}"
+    else:
+        run_name_tmp = run_name
+
+    job, message = _match_job(job_name, available_jobs)
+    print(message)
+    if job is None:
+        return False, message
+    return _run_job_wrapper(job_id=job['JobId'], run_name=run_name_tmp)
+
 @run_manual_job.register(list)
 def _(job_name:list, cluster_id=None, workspace_id=None, run_name=None):
     run_results = []
@@ -256,6 +305,48 @@ def _(job_name:list, cluster_id=None, workspace_id=None, run_name=None):
             pass
     return run_results
 
+@run_manual_job.register(dict)
+def _(job_name:dict, cluster_id=None, workspace_id=None, run_name=None):
+    return run_job_dag(job_name, cluster_id=cluster_id, workspace_id=workspace_id, run_name=run_name)
+
+def run_job_dag(dependencies: "Dict[str, List[str]]", cluster_id: str = None, workspace_id: str = None,
+                run_name: str = None, max_concurrent_runs: int = 4, retries: int = 0):
+    """
+    Run jobs concurrently, starting each job once the jobs it depends on have finished.
+    dependencies: job look up names (see run_manual_job) mapped to the look up names of the jobs they depend on.
+    At most max_concurrent_runs jobs run at a time, keep this within the capacity of the cluster.
+    Jobs whose dependencies fail are skipped. All runs are tracked by one shared poller.
+    Returns the Status, Error, Start, End and Seconds of each job, the critical path and its duration.
+    """
+    available_jobs = list_jobs(workspace_id=workspace_id, cluster_id=cluster_id)
+    jobs = {}
+    for name in dependencies:
+        job, message = _match_job(name, available_jobs)
+        if job is None:
+            raise Exception(message)
+        jobs[name] = job
+
+    def job_task(name):
+        def task(inputs):
+            run_name_tmp = run_name or f"{name}_manual_{datetime.datetime.utcnow()}"
+            print(f"Commencing job: {jobs[name]['JobName']}")
+            success, message = _run_job_wrapper(job_id=jobs[name]['JobId'], run_name=run_name_tmp)
+            if not success:
+                raise Exception(message)
+            return message
+        return task
+
+    start = time.time()
+    results = dag.run_dag({name : job_task(name) for name in dependencies}, dependencies,
+                          max_workers=max_concurrent_runs, retries=retries)
+    seconds = time.time() - start
+    path, path_seconds = dag.critical_path(dependencies, {name : result["Seconds"] for name, result in results.items()})
+    for name in dag.topological_order(dependencies):
+        result = results[name]
+        print(f"{name}: {result['Status']} in {result['Seconds']:.0f}s" + (f" ({result['Error']})" if result['Error'] else ""))
+    print(f"Finished in {seconds:.0f}s, critical path {' -> '.join(path)} took {path_seconds:.0f}s")
+    return {"Jobs" : results, "CriticalPath" : path, "CriticalPathSeconds" : path_seconds, "Seconds" : seconds}
+
 def run_schedule(job_id: str, schedule_name: str, utc_cron_expression: str, 
             override_script_parameters: "List[script_parameter]" = None,
             override_import_tables: "List[import_table]" = None,
@@ -284,14 +375,14 @@ def load_pyspark_notebook_to_str(file_name: str):
     """
     Read a python notebook as a string into a variable. This variable can be given to submit_job
     """
-    tmp_file=str(uuid.uuid4())
     if not os.path.isfile(file_name) :
         raise Exception(file_name + " does not exist")
-    os.system("jupyter nbconvert --to script '" + file_name +"' --output '" + tmp_file + "'")
-    file=open(tmp_file+".py")
-    script=file.read()
-    file.close()
-    os.remove(tmp_file+".py")
+    with temp_file(".py", local=True) as tmp_file:
+        os.system("jupyter nbconvert --to script '" + file_name +"' --output-dir '" + os.path.dirname(tmp_file.path) +
+                  "' --output '" + os.path.basename(tmp_file.path)[:-3] + "'")
+        file=open(tmp_file.path)
+        script=file.read()
+        file.close()
     return script
     
 def list_libraries(workspace_id: str = None, cluster_id: str = None, show_all: bool = False):
@@ -369,6 +460,7 @@ def create_cluster(cluster_name: str, spark_version: str = None, node_type_id: s
     """
     Create a new spark cluster
     """
+    clear_cluster_cache()
     create_cluster_response = neuro_call("80", "sparkmanager", "CreateCluster", 
                                      {
                                          "WorkspaceId" : workspace_id,
@@ -391,6 +483,7 @@ def edit_cluster(cluster_name: str=None, spark_version: str = None, node_type_id
     Edit a spark cluster
     This will cause it to restart
     """
+    clear_cluster_cache()
     edit_cluster_response = neuro_call("80", "sparkmanager", "EditCluster", 
                                      {
                                          "ClusterId" : cluster_id,
@@ -406,38 +499,44 @@ def edit_cluster(cluster_name: str=None, spark_version: str = None, node_type_id
                                      }
                                    )
 
-def list_clusters(workspace_id: str = None):
+def list_clusters(workspace_id: str = None, max_age: float = 0):
     """
     List spark clusters
-    """
-    list_clusters_response = neuro_call("80", "sparkmanager", "ListClusters", 
-                                     {
-                                         "WorkspaceId" : workspace_id
-                                     }
-                                   )
-    del list_clusters_response['Error']
-    del list_clusters_response['ErrorCode']
-    return list_clusters_response['Clusters']
+    max_age: reuse a listing fetched within this many seconds
+    """
+    def fetch():
+        list_clusters_response = neuro_call("80", "sparkmanager", "ListClusters", 
+                                         {
+                                             "WorkspaceId" : workspace_id
+                                         }
+                                       )
+        del list_clusters_response['Error']
+        del list_clusters_response['ErrorCode']
+        return list_clusters_response['Clusters']
+    return _cached_listing(("Clusters", workspace_id), max_age, fetch)
 
-def list_workspaces():
+def list_workspaces(max_age: float = 0):
     """
     List spark workspaces
-    """
-    list_clusters_response = neuro_call("80", "sparkmanager", "ListWorkspaces", 
-                                     {
-                                         
-                                     }
-                                   )
-    del list_clusters_response['Error']
-    del list_clusters_response['ErrorCode']
-    return list_clusters_response['Workspaces']
+    max_age: reuse a listing fetched within this many seconds
+    """
+    def fetch():
+        list_clusters_response = neuro_call("80", "sparkmanager", "ListWorkspaces", 
+                                         {
+                                             
+                                         }
+                                       )
+        del list_clusters_response['Error']
+        del list_clusters_response['ErrorCode']
+        return list_clusters_response['Workspaces']
+    return _cached_listing(("Workspaces",), max_age, fetch)
 
 def get_workspace_id(find: Union[str, int] = 0) -> str:
     """
     Get a workspace ID either by index or WorkspaceName
     """
     if isinstance(find, str):
-        workspaceID = next((wrk_json["WorkspaceId"] for wrk_json in list_workspaces()
+        workspaceID = next((wrk_json["WorkspaceId"] for wrk_json in list_workspaces(max_age=CLUSTER_CACHE_SECONDS)
                             if wrk_json["WorkspaceName"]==find),
                             None
                           )
@@ -445,7 +544,7 @@ def get_workspace_id(find: Union[str, int] = 0) -> str:
             print("No Workspace with given name")
         return workspaceID
     elif isinstance(find, int):
-        return list_workspaces()[find]["WorkspaceId"]
+        return list_workspaces(max_age=CLUSTER_CACHE_SECONDS)[find]["WorkspaceId"]
     else:
         raise TypeError(f'The look up arg `find` must be a string or integer, got {type(find)}')
 
@@ -453,7 +552,7 @@ def get_cluster_id(find: Union[str, int], workspace_id: str = None) -> str:
     """
     Get a workspace ID either by index or WorkspaceName
     """
-    cluster_list = list_clusters(workspace_id)
+    cluster_list = list_clusters(workspace_id, max_age=CLUSTER_CACHE_SECONDS)
     if isinstance(find, str):
         clusterID = next((clst_json["ClusterId"]
                           for clst_json in cluster_list
@@ -472,12 +571,14 @@ def get_cluster_id(find: Union[str, int], workspace_id: str = None) -> str:
     else:
         raise TypeError(f'The look up arg `find` must be a string or integer, got {type(find)}')
 
-def get_cluster_status(cluster_id: str = None, workspace_id: str = None) -> str:
+def get_cluster_status(cluster_id: str = None, workspace_id: str = None, max_age: float = None) -> str:
     """
     return cluster status from neuro_call
+    max_age: reuse a cluster listing fetched within this many seconds, defaults to CLUSTER_CACHE_SECONDS
     """
+    max_age = CLUSTER_CACHE_SECONDS if max_age is None else max_age
     return next((cluster['State']
-                 for cluster in list_clusters(workspace_id=workspace_id)
+                 for cluster in list_clusters(workspace_id=workspace_id, max_age=max_age)
                  if cluster['ClusterId']==cluster_id),
                  'NO CLUSTER FOUND'
                 )
@@ -487,6 +588,7 @@ def restart_cluster(cluster_id: str = None, workspace_id: str = None):
     Restart a cluster
     Useful for downgrading libraries
     """
+    clear_cluster_cache()
     restart_cluster_response = neuro_call("80", "sparkmanager", "RestartCluster", 
                                      {
                                          "ClusterId" : cluster_id,
@@ -498,6 +600,7 @@ def start_cluster(cluster_id: str = None, workspace_id: str = None):
     """
     Start a cluster
     """
+    clear_cluster_cache()
     start_cluster_response = neuro_call("80", "sparkmanager", "StartCluster", 
                                      {
                                          "ClusterId" : cluster_id,
@@ -505,6 +608,78 @@ def start_cluster(cluster_id: str = None, workspace_id: str = None):
                                      }
                                    )
 
+def _inspect_cluster(key: "Tuple[str, str]"):
+    workspace_id, cluster_id = key
+    return {"ClusterId" : cluster_id, "Status" : get_cluster_status(cluster_id, workspace_id)}
+
+_cluster_pollers = {}
+_cluster_waiters = {}
+
+def _failed_cluster_states(state: str):
+    """
+    States a cluster won't reach the target state from without being started again
+    """
+    failed = ['NO CLUSTER FOUND', 'ERROR'] + (['TERMINATED'] if state.upper()=='RUNNING' else [])
+    return [failed_state for failed_state in failed if failed_state!=state.upper()]
+
+def wait_for_state(cluster_id: str, state: str = 'RUNNING', timeout: float = None, callback = None,
+                   workspace_id: str = None, block: bool = True):
+    """
+    Wait for a cluster to reach a state.
+    All waiters for the same cluster and state share one poll, which backs off from 5 to 60 seconds and reads
+    the cached cluster listing, so waiting from several threads doesn't add ListClusters calls.
+    The poll stops when the last blocking waiter times out, or when the cluster is in a state it won't reach
+    the target state from, eg. TERMINATED or ERROR while waiting for RUNNING, which raises a ProcessLookupError.
+    callback(cluster_id, state) is called when the cluster reaches the state.
+    timeout: seconds to wait before raising a TimeoutError, None waits until the state is reached.
+    block: when False the future of the wait is returned straight away, it resolves to None if the wait is cancelled.
+    """
+    key = (workspace_id, cluster_id)
+    with _pollers_lock:
+        if state not in _cluster_pollers:
+            _cluster_pollers[state] = StatusPoller(_inspect_cluster, [state] + _failed_cluster_states(state),
+                                                   min_interval=5.0, max_interval=60.0)
+        poller = _cluster_pollers[state]
+        future = poller.track(key)
+        if block:
+            _cluster_waiters[(state, key)] = _cluster_waiters.get((state, key), 0) + 1
+    if callback is not None:
+        def on_done(done):
+            if done.exception() is None and done.result() is not None and done.result()['Status'].lower()==state.lower():
+                callback(cluster_id, state)
+        future.add_done_callback(on_done)
+    if not block:
+        return future
+    try:
+        result = future.result(timeout)
+    except FutureTimeoutError:
+        raise TimeoutError(f'Cluster {cluster_id} did not reach {state} within {timeout} seconds')
+    finally:
+        with _pollers_lock:
+            _cluster_waiters[(state, key)] -= 1
+            if _cluster_waiters[(state, key)] == 0:
+                del _cluster_waiters[(state, key)]
+                if not future.done():
+                    poller.cancel(key)
+    if result is None:
+        raise TimeoutError(f'Waiting for cluster {cluster_id} to reach {state} was cancelled')
+    if result['Status']=='NO CLUSTER FOUND':
+        raise ProcessLookupError(f'Cluster {cluster_id} was not found while waiting for {state}')
+    if result['Status'].lower()!=state.lower():
+        raise ProcessLookupError(f'Cluster {cluster_id} is {result["Status"]} and will not reach {state}')
+    return state
+
+def _wait_to_leave_state(cluster_id: str, workspace_id: str, state: str, timeout: float = 120):
+    """
+    Wait for a cluster that was just started or restarted to leave its previous state, so a listing from
+    before the change isn't taken as its result
+    """
+    start = time.time()
+    while time.time() - start < timeout:
+        time.sleep(5)
+        if get_cluster_status(cluster_id, workspace_id, max_age=0)!=state:
+            return
+
 def kickoff_cluster(cluster_id: str = None, workspace_id: str = None, force_restart: bool = False):
     """
     Allows user to attempt to start cluster safely, not doing so if cluster is running. Will also 
@@ -516,24 +691,18 @@ def kickoff_cluster(cluster_id: str = None, workspace_id: str = None, force_rest
     elif status=='RUNNING' and force_restart:
         print('Cluster running, forcing restart now. This will take 3 - 10 minutes.')
         restart_cluster(cluster_id, workspace_id)
-        time.sleep(5)
-        while status!='RUNNING':
-            time.sleep(10)
-            status = get_cluster_status(cluster_id, workspace_id)
+        _wait_to_leave_state(cluster_id, workspace_id, 'RUNNING')
+        wait_for_state(cluster_id, 'RUNNING', workspace_id=workspace_id)
         print("Finished restart, Cluster is ready")
     elif status in ['PENDING', 'RESIZING']:
         print(f'Cluster is in a {status.lower()} state, will be ready soon.')
-        while status!='RUNNING':
-            time.sleep(10)
-            status = get_cluster_status(cluster_id, workspace_id)
+        wait_for_state(cluster_id, 'RUNNING', workspace_id=workspace_id)
         print("Cluster is ready")
     elif status=='TERMINATED':
         print(f'Spinning up cluster now. This will take 3 - 10 minutes.')
         start_cluster(cluster_id, workspace_id)
-        time.sleep(5)
-        while status!='RUNNING':
-            time.sleep(10)
-            status = get_cluster_status(cluster_id, workspace_id)
+        _wait_to_leave_state(cluster_id, workspace_id, 'TERMINATED')
+        wait_for_state(cluster_id, 'RUNNING', workspace_id=workspace_id)
         print("Cluster is ready")
     else:
         raise ProcessLookupError(f'Cluster was in unexpected state ({status}) please reach out to support')
@@ -542,6 +711,7 @@ def delete_cluster(cluster_id: str = None, workspace_id: str = None):
     """
     Delete a cluster
     """
+    clear_cluster_cache()
     delete_cluster_response = neuro_call("80", "sparkmanager", "DeleteCluster", 
                                      {
                                          "ClusterId" : cluster_id,
@@ -714,70 +884,476 @@ def inspect_command(command_id: str):
     del inspect_command_response['ErrorCode']
     return inspect_command_response
 
+_TERMINAL_STATUSES = ['Finished', 'Cancelled', 'Error']
+_STATUS_PROGRESS = {'Queued' : 0.1, 'Running' : 0.5, 'Cancelling' : 0.9, 'Finished' : 1.0, 'Cancelled' : 1.0, 'Error' : 1.0}
+
+class StatusPoller:
+    """
+    Tracks outstanding items, such as commands or job runs, from one background thread.
+    inspect(key) returns a dict with a Status, each item is inspected until its Status is one of
+    terminal_statuses and its future is then resolved with the inspect result, or None if it was cancelled.
+    The polling interval starts at min_interval, doubles up to max_interval while no status changes and
+    resets when a status changes or a new item is tracked.
+    """
+    def __init__(self, inspect, terminal_statuses: "List[str]", cancel = None, min_interval: float = 0.5,
+                 max_interval: float = 5.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._inspect = inspect
+        self._terminal_statuses = [status.lower() for status in terminal_statuses]
+        self._cancel = cancel
+        self._items = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def track(self, key, on_status=None) -> Future:
+        """
+        Track an item and return a future for its final inspect result.
+        on_status(status, result) is called each time the status of the item changes.
+        """
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = {"Future" : Future(), "Status" : None, "Callbacks" : []}
+            entry = self._items[key]
+            if on_status is not None:
+                entry["Callbacks"].append(on_status)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return entry["Future"]
+
+    def cancel(self, key):
+        """
+        Cancel a tracked item. Returns False if the item is not being tracked.
+        """
+        with self._lock:
+            entry = self._items.pop(key, None)
+        if entry is None:
+            return False
+        if self._cancel is not None:
+            self._cancel(key)
+        self._notify(entry, 'Cancelled', None)
+        entry["Future"].set_result(None)
+        return True
+
+    def outstanding(self):
+        """
+        Keys of the items that haven't finished
+        """
+        with self._lock:
+            return list(self._items.keys())
+
+    def _notify(self, entry: dict, status: str, result: dict):
+        for callback in entry["Callbacks"]:
+            try:
+                callback(status, result)
+            except Exception as err:
+                print("Status callback failed: " + str(err))
+
+    def _run(self):
+        interval = self.min_interval
+        while True:
+            with self._lock:
+                if len(self._items) == 0:
+                    self._thread = None
+                    return
+                keys = list(self._items.keys())
+            changed = False
+            for key in keys:
+                try:
+                    result = self._inspect(key)
+                except Exception as err:
+                    with self._lock:
+                        entry = self._items.pop(key, None)
+                    if entry is not None:
+                        entry["Future"].set_exception(err)
+                    continue
+                with self._lock:
+                    entry = self._items.get(key)
+                    if entry is None or entry["Status"] == result["Status"]:
+                        continue
+                    entry["Status"] = result["Status"]
+                    finished = str(result["Status"]).lower() in self._terminal_statuses
+                    if finished:
+                        del self._items[key]
+                changed = True
+                self._notify(entry, result["Status"], result)
+                if finished:
+                    entry["Future"].set_result(result)
+            if changed:
+                interval = self.min_interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+            if self._wake.wait(interval):
+                interval = self.min_interval
+            self._wake.clear()
+
+class CommandPoller(StatusPoller):
+    """
+    Tracks the outstanding commands of a spark context by CommandId, see StatusPoller
+    """
+    def __init__(self, context_id: str, min_interval: float = 0.5, max_interval: float = 5.0):
+        super().__init__(inspect_command, _TERMINAL_STATUSES, cancel_command, min_interval, max_interval)
+        self.context_id = context_id
+
+_pollers = {}
+_pollers_lock = threading.Lock()
+
+def get_poller(context: str = None) -> CommandPoller:
+    """
+    The shared command poller of a context, defaults to the current context
+    """
+    context = context_id if context is None else context
+    with _pollers_lock:
+        if context not in _pollers:
+            _pollers[context] = CommandPoller(context)
+        return _pollers[context]
+
+def wait_for_command(command_id: str, context: str = None, timeout: float = None):
+    """
+    Wait for a command to finish and return its inspect_command result, None if it was cancelled
+    """
+    return get_poller(context).track(command_id).result(timeout)
+
+def _progress_callback(progress):
+    """
+    Status callback that moves a progress bar when the status of a command changes
+    """
+    def on_status(status, result):
+        progress.value = _STATUS_PROGRESS.get(status, progress.value)
+        progress.description = status
+    return on_status
+
 def spark_magic(button,progress,command,out,output,user_ns,silent=False):
-    stop=[0,0]
-    
+    """
+    Track a command with the shared poller of the current context and show its result when it finishes.
+    Returns a future that resolves to True when the command finished without an error.
+    """
+    poller = get_poller()
+    done = Future()
+
     def on_button_clicked(b):
-        stop[0]=1
+        poller.cancel(command['CommandId'])
     button.on_click(on_button_clicked)
-    def work(command,stop,out,output,user_ns,silent):
-        while inspect_command(command['CommandId'])['Status']!='Finished' and stop[0]==0:
-            time.sleep(1)
-        if stop[0]==1:
-            cancel_command(command['CommandId'])
-            stop[0]=1
+
+    def on_done(future):
+        try:
+            result = future.result()
+        except Exception as err:
+            output.append_display_data(str(err))
+            done.set_result(False)
+            return
+        if result is None or result['Status']=='Cancelled':
             output.append_display_data('Cancelled')
+            done.set_result(False)
+        elif result['Status']!='Finished' or result['Result']['ResultType']=='error':
+            output.append_display_data(HTML((result.get('Result') or {}).get('Summary') or result['Status']))
+            done.set_result(False)
         else:
-            result=inspect_command(command['CommandId'])
-            if result['Result']['ResultType']=='error':
-                stop[0]=1
-                output.append_display_data(HTML(result['Result']['Summary']))
+            if out is None:
+                if not silent:
+                    if result['Result']['Data']!='':
+                        output.append_display_data(result['Result']['Data'])
             else:
-                if out is None:
-                    stop[0]=1
-                    stop[1]=1
-                    if not silent:
-                        if result['Result']['Data']!='':
-                            output.append_display_data(result['Result']['Data'])
-                else:
-                    stop[0]=1
-                    stop[1]=1
-                    user_ns[out] = result['Result']['Data']
+                user_ns[out] = result['Result']['Data']
+            done.set_result(True)
 
-    
-    thread = threading.Thread(target=work, args=(command,stop,out,output,user_ns,silent))
-    thread.start()
+    poller.track(command['CommandId'], _progress_callback(progress)).add_done_callback(on_done)
+    return done
 
-    
+def command_output(result: dict):
+    """
+    The output of a finished command from its inspect_command result.
+    An exception is raised if the command failed or was cancelled.
+    """
+    if result is None:
+        raise Exception("Command cancelled")
+    if result['Status']!='Finished' or result['Result']['ResultType']=='error':
+        raise Exception("Spark error: " + str((result.get('Result') or {}).get('Summary') or result['Status']))
+    return result['Result']['Data']
 
-    def progress_work(progress,stop):
-        while stop[0]==0:
-            progress.value = 0
-            total = 100
-            for i in range(total):
-                time.sleep(0.02)
-                progress.value = float(i+1)/total
-                if stop[0]==1:
-                    break
-        progress.value = 1
-
-    thread1 = threading.Thread(target=progress_work, args=(progress,stop,))
-    thread1.start()
-    return stop
+def run_command(context: str, code: str, on_status=None, command_ids: set = None):
+    """
+    Run a command in a context, wait for it and return its output
+    command_ids: a set the CommandId is added to, eg. to cancel the command
+    """
+    command = execute_command(context, '1', code)
+    if command_ids is not None:
+        command_ids.add(command['CommandId'])
+    return command_output(get_poller(context).track(command['CommandId'], on_status).result())
 
-def checkForLimits(dataframe_name,store_name):
+def import_tables(context: str, tables: "List[import_table]", max_concurrent: int = 8, on_status=None,
+                  command_ids: set = None):
+    """
+    Import tables into a spark context with up to max_concurrent import commands running at a time,
+    then register a temp view for every imported dataframe in one command.
+    command_ids: a set the CommandId of each submitted import is added to, eg. to cancel only these commands.
+    Returns the Status, Seconds and Error of each import by dataframe name.
+    """
+    poller = get_poller(context)
+    command_ids = set() if command_ids is None else command_ids
+
+    def run(table):
+        start = time.time()
+        error = None
+        try:
+            command = execute_import_table_command(context, table)
+            command_ids.add(command['CommandId'])
+            result = poller.track(command['CommandId'], on_status).result()
+            if result is None:
+                error = "Cancelled"
+            elif result['Status']!='Finished' or result['Result']['ResultType']=='error':
+                error = (result.get('Result') or {}).get('Summary') or result['Status']
+        except Exception as err:
+            error = str(err)
+        return {"Status" : "Failed" if error is not None else "Imported", "Seconds" : time.time() - start, "Error" : error}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrent)) as executor:
+        results = list(executor.map(run, tables))
+    results = {table['SparkDataFrameName'] : result for table, result in zip(tables, results)}
+
+    imported = [name for name, result in results.items() if result["Status"]=="Imported"]
+    if len(imported) > 0:
+        run_command(context, "\n".join(["%s.createOrReplaceTempView('%s')"%(name, name) for name in imported]), on_status)
+    return results
+
+def _arrow_transfer_command(dataframe_name: str, payload_name: str, columns: "List[str]", limit: int, page_size: int):
+    """
+    Remote code that serialises a spark dataframe to base64 encoded Arrow IPC and prints a json header
+    followed by the first page of the payload
+    """
+    select = "" if columns is None else ".select(%s)"%", ".join([repr(col) for col in columns])
+    limit = "" if limit is None else ".limit(%s)"%int(limit)
+    return '''
+import json, base64, pyarrow
+_table = pyarrow.Table.from_pandas(%(df)s%(select)s%(limit)s.toPandas(), preserve_index=False)
+_sink = pyarrow.BufferOutputStream()
+_writer = pyarrow.ipc.new_stream(_sink, _table.schema)
+_writer.write_table(_table)
+_writer.close()
+%(payload)s = base64.b64encode(_sink.getvalue().to_pybytes()).decode()
+print(json.dumps({"Pages" : -(-len(%(payload)s) // %(page_size)s), "Rows" : _table.num_rows}) + "\\n" + %(payload)s[:%(page_size)s])
+if len(%(payload)s) <= %(page_size)s:
+    del %(payload)s
+del _table, _sink, _writer'''%{"df" : dataframe_name, "select" : select, "limit" : limit, "payload" : payload_name,
+         "page_size" : int(page_size)}
+
+def spark_to_pandas(dataframe_name: str, columns: "List[str]" = None, limit: int = None, context: str = None,
+                    page_size: int = 4000000, on_status=None, command_ids: set = None) -> pd.DataFrame:
+    """
+    Move a spark dataframe in a context into a pandas dataframe keeping its column types.
+    The dataframe, or only its columns and first limit rows, is serialised to Arrow IPC in the context and
+    returned base64 encoded in pages of page_size characters, so most results arrive in one command.
+    on_status(status, result) is called when the status of a transfer command changes.
+    command_ids: a set the CommandId of each transfer command is added to, eg. to cancel the transfer.
+    """
+    context = context_id if context is None else context
+    payload_name = "_neuro_payload_" + uuid.uuid4().hex
+    data = run_command(context, _arrow_transfer_command(dataframe_name, payload_name, columns, limit, page_size),
+                       on_status, command_ids)
+    header, _, first_page = data.strip().partition('\n')
+    pages = [first_page.strip()]
+    page_count = json.loads(header)["Pages"]
+    for page in range(1, page_count):
+        code = "print(%s[%s:%s])"%(payload_name, page * page_size, (page + 1) * page_size)
+        if page == page_count - 1:
+            code += "\ndel %s"%payload_name
+        pages.append(run_command(context, code, on_status, command_ids).strip())
+    reader = pyarrow.ipc.open_stream(pyarrow.py_buffer(base64.b64decode("".join(pages))))
+    return reader.read_pandas()
+
+def datalake_to_pandas(data_store_name: str, table_name: str, partition_paths: "List[str]" = None,
+                       columns: "List[str]" = None, where: str = None, limit: int = None, context: str = None,
+                       on_status=None) -> pd.DataFrame:
+    """
+    Read a datalake table into a pandas dataframe through a spark context, keeping the table's file format
+    until the result is serialised to Arrow by spark_to_pandas.
+    The table is imported with an import_table command so delta tables are read through their delta log.
+    partition_paths: partition paths in import_table form, defaults to the whole table.
+    columns and where (a spark sql condition) are applied in spark before the transfer, so spark prunes the
+    columns and pushes the predicates down into the parquet or delta scan.
+    """
+    context = context_id if context is None else context
+    dataframe_name = "_neuro_import_" + uuid.uuid4().hex
+    command = execute_import_table_command(context, import_table(dataframe_name, data_store_name, table_name,
+                                                                 partition_paths or ["'/'"]))
+    command_output(get_poller(context).track(command['CommandId'], on_status).result())
+    try:
+        expression = dataframe_name if where is None else "%s.filter(%r)"%(dataframe_name, where)
+        return spark_to_pandas(expression, columns=columns, limit=limit, context=context, on_status=on_status)
+    finally:
+        run_command(context, "del %s"%dataframe_name)
+
+#Rows shown when a result is only displayed and no limit is given
+DISPLAY_LIMIT=1000
+
+def _transfer_to_notebook(context, dataframe_name, columns, limit, out, progress, output, user_ns, button=None):
+    """
+    Move a spark dataframe into user_ns[out], or display it in output when out is None.
+    A displayed result is limited to DISPLAY_LIMIT rows unless a limit is given.
+    The button cancels the transfer commands.
+    """
+    if out is None and limit is None:
+        limit = DISPLAY_LIMIT
+    command_ids = set()
+    if button is not None:
+        poller = get_poller(context)
+        def on_button_clicked(b):
+            for command_id in list(command_ids):
+                poller.cancel(command_id)
+        button.on_click(on_button_clicked)
+    try:
+        df = spark_to_pandas(dataframe_name, columns=columns, limit=limit, context=context,
+                             on_status=_progress_callback(progress), command_ids=command_ids)
+    except Exception as err:
+        output.append_display_data(HTML(str(err)))
+        return
+    if out is None:
+        output.append_display_data(HTML(df.to_html()))
+    else:
+        user_ns[out] = df
+
+def _batch_script(marker: str, statements: "List[str]"):
+    """
+    One script running each statement in turn, with its output delimited by markers.
+    A statement that raises prints an error marker with its index followed by the traceback.
+    A statement that is a single expression has its value printed unless it is None.
+    """
+    lines = ["import sys as _batch_sys, traceback as _batch_traceback"]
+    for ind, code in enumerate(statements):
+        try:
+            compile(code, "<batch>", "eval")
+            code = "_batch_value = (%s\n)\nif _batch_value is not None:\n    print(_batch_value)"%code.strip()
+        except SyntaxError:
+            pass
+        lines += ["print(%r)"%("<<%s:%s>>"%(marker, ind)),
+                  "try:",
+                  "    exec(%r, globals())"%code,
+                  "except Exception:",
+                  "    print(%r)"%("<<%s:error:%s>>"%(marker, ind)),
+                  "    _batch_traceback.print_exc(file=_batch_sys.stdout)"]
+    lines.append("print(%r)"%("<<%s:end>>"%marker))
+    return "\n".join(lines)
+
+def _resolve_batch(future: Future, marker: str, pending: list):
+    """
+    Split the output of a batch script back out to the futures of its statements
+    """
+    try:
+        output = command_output(future.result())
+    except Exception as err:
+        for code, statement_future in pending:
+            statement_future.set_exception(err)
+        return
+    for ind, (code, statement_future) in enumerate(pending):
+        start = "<<%s:%s>>"%(marker, ind)
+        if start not in output:
+            statement_future.set_exception(Exception("Batched command did not run: " + code))
+            continue
+        section = output.split(start, 1)[1]
+        for end in ["<<%s:%s>>"%(marker, ind + 1), "<<%s:end>>"%marker]:
+            section = section.split(end, 1)[0]
+        error_marker = "<<%s:error:%s>>"%(marker, ind)
+        if error_marker in section:
+            printed, traceback_text = section.split(error_marker, 1)
+            statement_future.set_exception(Exception("Spark error: " + "\n".join(
+                [text.strip('\n') for text in [printed, traceback_text] if text.strip('\n') != ""])))
+        else:
+            statement_future.set_result(section.strip('\n'))
+
+class CommandBatcher:
+    """
+    Coalesces small commands for a context into one submitted script.
+    Commands submitted within window seconds of each other, up to max_batch commands, are sent together and the
+    future returned by submit resolves to the printed output of that command alone.
+    Used as a context manager, commands are held until the with block exits.
+    """
+    def __init__(self, context: str = None, window: float = 0.05, max_batch: int = 20):
+        self.context = context_id if context is None else context
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+        self._held = 0
+
+    def submit(self, code: str) -> Future:
+        """
+        Queue a command and return a future for its output
+        """
+        future = Future()
+        with self._lock:
+            self._pending.append((code, future))
+            flush_now = len(self._pending) >= self.max_batch
+            if not flush_now and self._timer is None and self._held == 0:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if flush_now:
+            self.flush()
+        return future
+
+    def flush(self):
+        """
+        Send the queued commands now
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, []
+        if len(pending) == 0:
+            return
+        marker = uuid.uuid4().hex
+        try:
+            command = execute_command(self.context, 'batch', _batch_script(marker, [code for code, future in pending]))
+        except Exception as err:
+            for code, future in pending:
+                future.set_exception(err)
+            return
+        get_poller(self.context).track(command['CommandId']).add_done_callback(
+            lambda future: _resolve_batch(future, marker, pending))
+
+    def __enter__(self):
+        with self._lock:
+            self._held += 1
+        return self
+
+    def __exit__(self, *args):
+        with self._lock:
+            self._held -= 1
+        self.flush()
+
+_batchers = {}
+
+def get_batcher(context: str = None) -> CommandBatcher:
+    """
+    The shared command batcher of a context, defaults to the current context
+    """
+    context = context_id if context is None else context
+    with _pollers_lock:
+        if context not in _batchers:
+            _batchers[context] = CommandBatcher(context)
+        return _batchers[context]
+
+def _submit_limit_check(dataframe_name, store_name, batcher):
     if store_name=='NeuroverseEvents':
         findLimitCommand='''
 if 'LocalLimit' in %s._jdf.queryExecution().toString():
     print(True)
 else:
     print(False)'''%dataframe_name
-        command=execute_command(context_id,'findLimit',findLimitCommand)
-        while inspect_command(command['CommandId'])['Status']!='Finished':
-            time.sleep(1)
-        result=inspect_command(command['CommandId'])
-        if result['Result']['Data']=='True':
-            print("Your limit on DataFrame:%s will not be applied. Consider cancelling and using a where clause instead."%dataframe_name)  
+        return batcher.submit(findLimitCommand)
+    return None
+
+def _report_limit_check(dataframe_name, probe):
+    if probe is not None and probe.exception() is None and probe.result()=='True':
+        print("Your limit on DataFrame:%s will not be applied. Consider cancelling and using a where clause instead."%dataframe_name)
+
+def checkForLimits(dataframe_name,store_name):
+    _report_limit_check(dataframe_name, _submit_limit_check(dataframe_name, store_name, get_batcher()))
 
 @magics_class
 class SparkMagics(Magics):
@@ -808,6 +1384,9 @@ class SparkMagics(Magics):
     @magic_arguments.argument('--out', '-o',
       help='The variable to return the results in'
     )
+    @magic_arguments.argument('--limit', '-l', type=int,
+      help='The maximum number of rows to return, defaults to DISPLAY_LIMIT when the result is only displayed'
+    )
     def spark_sql(self, line, cell):
         global context_id
         contextid=None
@@ -828,30 +1407,10 @@ class SparkMagics(Magics):
         progress = widgets.FloatProgress(value=0.0, min=0.0, max=1.0)
         display(widgets.VBox([output,widgets.HBox([widgets.Label("CommandId: %s"%command['CommandId']),progress,button])]))
         
-        stop=spark_magic(button,progress,command,out,output,self.shell.user_ns,silent=True)
-        while stop[0]==0:
-            time.sleep(1)
-        if stop[1]==1:
+        if spark_magic(button,progress,command,out,output,self.shell.user_ns,silent=True).result():
             if args.out!=None or args.dataframe==None:
-                command=execute_command(eval(contextid),'1','str(%s.columns)'%dataframe)
-                schema_out='A'+str(uuid.uuid4())
-                stop=spark_magic(button,progress,command,schema_out,output,self.shell.user_ns,silent=True)
-                while stop[0]==0:
-                    time.sleep(1)
-                if stop[1]==1:
-                    columns=[]
-                    for col in self.shell.user_ns[schema_out].split('[')[-1].strip(']"').replace("'","").split(','):
-                        columns.append(col)
-                    command2=execute_command(eval(contextid),'1','display(%s)'%dataframe)
-                    data_out='A'+str(uuid.uuid4())
-                    stop=spark_magic(button,progress,command2,data_out,output,self.shell.user_ns,silent=True)
-                    while stop[0]==0:
-                        time.sleep(1)
-                    if stop[1]==1:
-                        if args.out is None:
-                            output.append_display_data(HTML(pd.DataFrame.from_records(self.shell.user_ns[data_out],columns=columns).to_html()))
-                        else:
-                            self.shell.user_ns[args.out] = pd.DataFrame.from_records(self.shell.user_ns[data_out],columns=columns)
+                _transfer_to_notebook(eval(contextid),dataframe,None,args.limit,args.out,progress,output,self.shell.user_ns,
+                                      button)
     @line_magic
     @cell_magic
     @magic_arguments.magic_arguments()
@@ -870,6 +1429,9 @@ class SparkMagics(Magics):
     @magic_arguments.argument('--sqlquery', '-sq',
       help='The sql query'
     )
+    @magic_arguments.argument('--maxconcurrent', '-mc', type=int,
+      help='The maximum number of tables imported at the same time in cell mode. Defaults to 8.'
+    )
     def spark_import_table(self, line, cell=None):
         global context_id
         args = magic_arguments.parse_argstring(self.spark_import_table, line)
@@ -883,28 +1445,25 @@ class SparkMagics(Magics):
             temp_import_table=import_table(args.dataframe,args.storename,args.tablename,
                                            args.partitionpaths or ["'/'"],args.sqlquery)
             command=execute_import_table_command(eval(contextid),temp_import_table)
-            stop=spark_magic(button,progress,command,None,output,self.shell.user_ns,silent=True)
-            while stop[0]==0:
-                time.sleep(1)
-
-            if stop[1]==1:
+            if spark_magic(button,progress,command,None,output,self.shell.user_ns,silent=True).result():
                 code="%s.createOrReplaceTempView('%s')"%(temp_import_table['SparkDataFrameName'],temp_import_table['SparkDataFrameName'])
                 command1=execute_command(eval(contextid),'1',code)
-                stop=spark_magic(button,progress,command1,None,output,self.shell.user_ns)
+                spark_magic(button,progress,command1,None,output,self.shell.user_ns)
         else:
-            for cell_line in cell.split('\n'):
-                if cell_line != "":
-                    command=execute_import_table_command(eval(contextid),eval(cell_line))
-
-                    stop=spark_magic(button,progress,command,None,output,self.shell.user_ns,silent=True)
-                    while stop[0]==0:
-                        time.sleep(1)
-
-                    if stop[1]==1:
-                        temp_import_table=eval(cell_line)
-                        code="%s.createOrReplaceTempView('%s')"%(temp_import_table['SparkDataFrameName'],temp_import_table['SparkDataFrameName'])
-                        command1=execute_command(eval(contextid),'1',code)
-                        stop=spark_magic(button,progress,command1,None,output,self.shell.user_ns)  
+            poller=get_poller(eval(contextid))
+            command_ids=set()
+            def on_button_clicked(b):
+                for command_id in list(command_ids):
+                    poller.cancel(command_id)
+            button.on_click(on_button_clicked)
+            temp_import_tables=[eval(cell_line) for cell_line in cell.split('\n') if cell_line.strip() != ""]
+            try:
+                results=import_tables(eval(contextid),temp_import_tables,args.maxconcurrent or 8,_progress_callback(progress),
+                                      command_ids)
+            except Exception as err:
+                output.append_display_data(HTML(str(err)))
+                return
+            output.append_display_data(HTML(pd.DataFrame.from_dict(results,orient='index').to_html()))
     
     @line_magic
     @cell_magic
@@ -938,12 +1497,13 @@ class SparkMagics(Magics):
             command=execute_export_table_command(eval(contextid),temp_export_table)
             spark_magic(button,progress,command,None,output,self.shell.user_ns)
         else:
-            for cell_line in cell.split('\n'):
-                if cell_line != "":
-                    temp_export_table=eval(cell_line)
-                    checkForLimits(temp_export_table["SparkDataFrameName"],temp_export_table["DataStoreName"])
-                    command=execute_export_table_command(eval(contextid),temp_export_table)
-                    spark_magic(button,progress,command,None,output,self.shell.user_ns)
+            temp_export_tables=[eval(cell_line) for cell_line in cell.split('\n') if cell_line != ""]
+            with get_batcher(eval(contextid)) as batcher:
+                probes=[_submit_limit_check(table["SparkDataFrameName"],table["DataStoreName"],batcher) for table in temp_export_tables]
+            for temp_export_table,probe in zip(temp_export_tables,probes):
+                _report_limit_check(temp_export_table["SparkDataFrameName"],probe)
+                command=execute_export_table_command(eval(contextid),temp_export_table)
+                spark_magic(button,progress,command,None,output,self.shell.user_ns)
         
     @line_magic
     @magic_arguments.magic_arguments()
@@ -953,44 +1513,30 @@ class SparkMagics(Magics):
     @magic_arguments.argument('--out', '-o',
       help='The variable to return the results in'
     )
+    @magic_arguments.argument('--limit', '-l', type=int,
+      help='The maximum number of rows to return, defaults to DISPLAY_LIMIT when the result is only displayed'
+    )
+    @magic_arguments.argument('--columns', '-c',
+      help='Comma separated columns to return'
+    )
     def spark_pandas(self, line):
         global context_id
         contextid='"%s"'%context_id
         dataframe=''
         args = magic_arguments.parse_argstring(self.spark_pandas, line)
-        out=args.out
         if args.dataframe!=None:
             dataframe=args.dataframe
         else:
             raise Exception('dataframe parameter must be provided')
-        command=execute_command(eval(contextid),'1','str(%s.columns)'%dataframe)
+        columns=None
+        if args.columns!=None:
+            columns=[col.strip() for col in args.columns.split(',')]
         output = widgets.Output()
         button = widgets.Button(description="Cancel")
         progress = widgets.FloatProgress(value=0.0, min=0.0, max=1.0)
-        display(widgets.VBox([output,widgets.HBox([widgets.Label("CommandId: %s"%command['CommandId']),progress,button])]))
-        
-        schema_out='A'+str(uuid.uuid4())
-        stop=spark_magic(button,progress,command,schema_out,output,self.shell.user_ns,silent=True)
-        
-        while stop[0]==0:
-            time.sleep(1)
-        
-        if stop[1]==1:
-            columns=[]
-            for col in self.shell.user_ns[schema_out].split('[')[-1].strip(']"').replace("'","").split(','):
-                columns.append(col)
-
-            command2=execute_command(eval(contextid),'1','display(%s)'%dataframe)
-            data_out='A'+str(uuid.uuid4())
-            stop=spark_magic(button,progress,command2,data_out,output,self.shell.user_ns,silent=True)
-            while stop[0]==0:
-                time.sleep(1)
-        
-            if stop[1]==1:
-                if args.out is None:
-                    output.append_display_data(HTML(pd.DataFrame.from_records(self.shell.user_ns[data_out],columns=columns).to_html()))
-                else:
-                    self.shell.user_ns[args.out] = pd.DataFrame.from_records(self.shell.user_ns[data_out],columns=columns)
-        
+        display(widgets.VBox([output,widgets.HBox([widgets.Label("DataFrame: %s"%dataframe),progress,button])]))
+        _transfer_to_notebook(eval(contextid),dataframe,columns,args.limit,args.out,progress,output,self.shell.user_ns,
+                              button)
+
 ip = get_ipython()
 ip.register_magics(SparkMagics)
@@ -3,6 +3,12 @@ The neuro_data module contains:
     schema_manager(sm): Creates and stores the schema info for Neuroverse tables
     stream_table(st): Stream data from a source to a sink table in Neuroverse
     source_sink(ss): Source and sink parameters
+    sampling(sp): Sample rows from large tables
+    pipeline(pl): Run dependent stream stages concurrently
+    expression_evaluator(ee): Evaluate sink expressions and where clauses locally
+    materialised_view(mv): SQL views backed by incrementally refreshed tables
+    index_advisor(ia): Recommend sql indexes from the recorded query workload
+    catalog(ca): Local snapshot of data stores and table definitions
 """
 from neuro_python.neuro_data import schema_manager as sm
 from neuro_python.neuro_data import stream_table as st
@@ -11,3 +17,9 @@ from neuro_python.neuro_data import datalake_commands as dc
 from neuro_python.neuro_data import sql_query as sq
 from neuro_python.neuro_data import sql_commands as sc
 from neuro_python.neuro_data import event_manager as em
+from neuro_python.neuro_data import sampling as sp
+from neuro_python.neuro_data import pipeline as pl
+from neuro_python.neuro_data import expression_evaluator as ee
+from neuro_python.neuro_data import materialised_view as mv
+from neuro_python.neuro_data import index_advisor as ia
+from neuro_python.neuro_data import catalog as ca
@@ -0,0 +1,226 @@
+"""
+Local snapshot of the Neuroverse data stores, tables and table definitions.
+Once a catalog is built or loaded, path building and type mapping use it instead of calling the api.
+"""
+
+import os
+import copy
+import json
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from neuro_python import home_directory
+from neuro_python.neuro_call import neuro_call
+from neuro_python.neuro_data import schema_manager as sm
+
+_lock = threading.Lock()
+_catalog = None
+#Connection strings contain credentials so they are only kept in memory, never saved
+_connection_strings = {}
+
+def catalog_file():
+    return home_directory() + "/.neuro_catalog.json"
+
+def _fetch_tables(data_store: dict, known_tables: dict, max_workers: int):
+    """
+    Fetch the tables of a data store and their definitions.
+    When known_tables is supplied the data store's tables aren't listed again, only their definitions are fetched.
+    The api doesn't return when a definition was last changed, so every definition is fetched.
+    """
+    if known_tables is None:
+        table_infos = neuro_call("80", "DataPopulation", "GetTableInfos", {"DataStoreId" : data_store["DataStoreId"]})["TableInfos"]
+    else:
+        table_infos = [{"TableId" : table["TableId"], "TableName" : table["TableName"],
+                        "TableTypeId" : sm.SCHEMA_TYPE_MAP.get(table["SchemaType"])} for table in known_tables.values()]
+
+    def fetch(table):
+        table_defs = neuro_call("80", "DataPopulation", "GetDestinationTableDefinition",
+                                {"TableName" : table["TableName"], "DataStoreId" : data_store["DataStoreId"]})
+        table_def = None
+        if len(table_defs["DestinationTableDefinitions"]) > 0:
+            table_def = table_defs["DestinationTableDefinitions"][0]
+            table_def["DestinationTableDefinitionIndexes"] = []
+            table_def["DestinationTableDefinitionColumns"].sort(key=lambda y: y["Index"])
+        return {"TableId" : table["TableId"], "TableName" : table["TableName"],
+                "SchemaType" : sm.SCHEMA_TYPE_MAP_REV.get(table["TableTypeId"]), "TableDefinition" : table_def}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = list(executor.map(fetch, table_infos))
+    return {table["TableName"] : table for table in tables}
+
+def build_catalog(store_names: "List[str]" = None, max_workers: int = 8, save: bool = True, incremental: bool = False):
+    """
+    Build a catalog of data stores, tables and table definitions, fetching them concurrently.
+    store_names: only these data stores are included, defaults to all data stores.
+    incremental: reuse the table lists of data stores already in the catalog instead of listing their tables
+    again. Every table definition is still fetched, so definitions changed elsewhere are picked up, but
+    tables created since the catalog was built are only found by a full build.
+    The catalog is saved to .neuro_catalog.json in the home directory unless save is False.
+    """
+    global _catalog
+    data_stores = neuro_call("80", "datastoremanager", "GetDataStores", {})["DataStores"]
+    if store_names is not None:
+        data_stores = [ds for ds in data_stores if ds["StoreName"] in store_names]
+    previous = _catalog if incremental and _catalog is not None else {"DataStores" : {}}
+
+    def fetch(data_store):
+        known_tables = previous["DataStores"].get(data_store["StoreName"], {}).get("Tables")
+        return data_store, _fetch_tables(data_store, known_tables, max_workers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(fetch, data_stores))
+
+    catalog = {"BuiltAt" : datetime.datetime.utcnow().isoformat(), "DataStores" : {}}
+    for data_store, tables in results:
+        if "ConnectionString" in data_store:
+            _connection_strings[data_store["StoreName"]] = data_store["ConnectionString"]
+        store = {key : value for key, value in data_store.items() if key != "ConnectionString"}
+        store["Tables"] = tables
+        catalog["DataStores"][data_store["StoreName"]] = store
+    if store_names is not None and _catalog is not None:
+        for store_name, store in _catalog["DataStores"].items():
+            catalog["DataStores"].setdefault(store_name, store)
+
+    with _lock:
+        _catalog = catalog
+    if save:
+        save_catalog()
+    return catalog
+
+def refresh_catalog(background: bool = True, max_workers: int = 8):
+    """
+    Refresh the catalog incrementally, fetching every table definition again without listing the tables.
+    When background is set the refresh runs in a thread and the current catalog is used until it finishes.
+    """
+    if background:
+        thread = threading.Thread(target=build_catalog, kwargs={"max_workers" : max_workers, "incremental" : True},
+                                  daemon=True)
+        thread.start()
+        return thread
+    return build_catalog(max_workers=max_workers, incremental=True)
+
+def save_catalog(file_name: str = None):
+    """
+    Save the catalog to a file
+    """
+    file_name = file_name or catalog_file()
+    with _lock:
+        data = json.dumps(_catalog)
+    with open(file_name + ".tmp", "w") as file:
+        file.write(data)
+    os.replace(file_name + ".tmp", file_name)
+
+def load_catalog(file_name: str = None, refresh: bool = False):
+    """
+    Load a saved catalog. refresh also starts an incremental refresh in the background.
+    """
+    global _catalog
+    file_name = file_name or catalog_file()
+    if not os.path.isfile(file_name):
+        raise Exception("Catalog file doesn't exist, use build_catalog")
+    with open(file_name) as file:
+        catalog = json.loads(file.read())
+    with _lock:
+        _catalog = catalog
+    if refresh:
+        refresh_catalog(background=True)
+    return catalog
+
+def clear_catalog():
+    """
+    Stop using the catalog, all lookups call the api again
+    """
+    global _catalog
+    with _lock:
+        _catalog = None
+
+def invalidate(store_name: str, table_name: str = None):
+    """
+    Remove a table, or a whole data store, from the catalog so the next lookup fetches it again
+    """
+    with _lock:
+        if _catalog is None or store_name not in _catalog["DataStores"]:
+            return
+        if table_name is None:
+            del _catalog["DataStores"][store_name]
+        else:
+            _catalog["DataStores"][store_name]["Tables"].pop(table_name, None)
+
+def lookup_data_store(store_name: str, include_connection_string: bool = False):
+    """
+    Get a data store, from the catalog when it is loaded
+    """
+    with _lock:
+        store = None
+        if _catalog is not None:
+            store = _catalog["DataStores"].get(store_name)
+        if store is not None and (not include_connection_string or store_name in _connection_strings):
+            store = {key : value for key, value in store.items() if key != "Tables"}
+            if include_connection_string:
+                store["ConnectionString"] = _connection_strings[store_name]
+            return store
+    data_stores = neuro_call("80", "datastoremanager", "GetDataStores", {"StoreName" : store_name})["DataStores"]
+    if len(data_stores) == 0:
+        raise Exception("Data store doesn't exist")
+    data_store = data_stores[0]
+    with _lock:
+        if "ConnectionString" in data_store:
+            _connection_strings[store_name] = data_store["ConnectionString"]
+        if _catalog is not None and store_name not in _catalog["DataStores"]:
+            store = {key : value for key, value in data_store.items() if key != "ConnectionString"}
+            store["Tables"] = {}
+            _catalog["DataStores"][store_name] = store
+    return dict(data_store)
+
+def lookup_table_definition(store_name: str, table_name: str):
+    """
+    Get a table definition, from the catalog when it is loaded
+    """
+    with _lock:
+        if _catalog is not None:
+            table = _catalog["DataStores"].get(store_name, {}).get("Tables", {}).get(table_name)
+            if table is not None and table["TableDefinition"] is not None:
+                return copy.deepcopy(table["TableDefinition"])
+    table_def = sm.get_table_definition(store_name, table_name)
+    with _lock:
+        if _catalog is not None and store_name in _catalog["DataStores"]:
+            _catalog["DataStores"][store_name]["Tables"][table_name] = {
+                "TableId" : None, "TableName" : table_name,
+                "SchemaType" : sm.SCHEMA_TYPE_MAP_REV.get(table_def["SchemaType"]),
+                "TableDefinition" : copy.deepcopy(table_def)}
+    return table_def
+
+class TableHandle:
+    """
+    A table with its data store, schema type, file type, managed datalake path and column types resolved once.
+    Datalake commands and datalake source and sink parameters accept a TableHandle in place of the store name,
+    the table name argument is then ignored and can be None.
+    """
+    def __init__(self, store_name: str, table_name: str):
+        self.store_name = store_name
+        self.table_name = table_name
+        self.table_definition = lookup_table_definition(store_name, table_name)
+        self.data_store_id = self.table_definition.get("DataStoreId")
+        if self.data_store_id is None:
+            self.data_store_id = lookup_data_store(store_name)["DataStoreId"]
+        self.schema_type = sm.SCHEMA_TYPE_MAP_REV[self.table_definition["SchemaType"]]
+        self.file_type = sm.FILE_TYPE_MAP_REV[self.table_definition.get("FileType") or 0]
+        self.managed_path = ("/managed/" + self.schema_type + "/table/" + table_name + "/").lower()
+        self.column_names, self.column_types = sm.column_names_and_types(self.table_definition)
+
+    def file_path(self, file_name_including_partition: str):
+        """
+        Full datalake path of a file in the table
+        """
+        return self.managed_path + file_name_including_partition.strip('/')
+
+    def __repr__(self):
+        return "TableHandle(%r, %r)"%(self.store_name, self.table_name)
+
+def table_handle(store_name, table_name: str):
+    """
+    Return store_name if it is already a TableHandle, otherwise resolve a TableHandle for the table
+    """
+    if isinstance(store_name, TableHandle):
+        return store_name
+    return TableHandle(store_name, table_name)
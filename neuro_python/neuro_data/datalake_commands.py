@@ -4,23 +4,25 @@ Helper commands for a datalake
 
 import os
 import time
-import uuid
+from concurrent.futures import ThreadPoolExecutor
 import pandas
 from neuro_python import home_directory
+from neuro_python import checkpoint
 from neuro_python.neuro_call import neuro_call
+from neuro_python.temp_storage import temp_file
 from neuro_python.neuro_data import schema_manager as sm
+from neuro_python.neuro_data import catalog as ca
 from neuro_python.neuro_data import source_sink as ss
 from neuro_python.neuro_data import stream_table as st
 
 def delete_datalake_file(store_name: str, table_name: str, file_name_including_partition: str):
     """
     Delete a file from a processed datalake table in Neuroverse
+    store_name can be a TableHandle
     """
-    table_def = sm.get_table_definition(store_name, table_name)
-    schema_type = list(sm.SCHEMA_TYPE_MAP.keys())[list(sm.SCHEMA_TYPE_MAP.values()).index(table_def["SchemaType"])]
-    file_path = "/managed/" + schema_type + "/table/" + table_name + "/"
-    file_path = file_path.lower()
-    file_path += file_name_including_partition.strip('/')
+    table = ca.table_handle(store_name, table_name)
+    store_name, table_name = table.store_name, table.table_name
+    file_path = table.file_path(file_name_including_partition)
 
     request = {"DataStoreName" : store_name, "TableName" : table_name, "FilePath" : file_path}
     response = neuro_call("80", "DataMovementService", "DataLakeDeleteFile", request)
@@ -45,7 +47,10 @@ def delete_datalake_file(store_name: str, table_name: str, file_name_including_p
 def list_datalake_table_files_with_partitions(store_name: str, table_name: str):
     """
     List all the files associated with a datalake file in Neuroverse
+    store_name can be a TableHandle
     """
+    if isinstance(store_name, ca.TableHandle):
+        store_name, table_name = store_name.store_name, store_name.table_name
     request = {"DataStoreName" : store_name, "TableName" : table_name}
     files = neuro_call("80", "DataMovementService", "ListDataLakeTableFiles", request)["Files"]
     return_list = []
@@ -56,10 +61,11 @@ def list_datalake_table_files_with_partitions(store_name: str, table_name: str):
 def list_datalake_table_directory_items(store_name: str, table_name: str, directory_path: str):
     """
     List all the items associated with a directory in a table in a datalake file in Neuroverse
+    store_name can be a TableHandle
     """
-    table_def = sm.get_table_definition(store_name, table_name)
-    schema_type = list(sm.SCHEMA_TYPE_MAP.keys())[list(sm.SCHEMA_TYPE_MAP.values()).index(table_def["SchemaType"])]
-    directory_path = "/managed/" + schema_type + "/table/" + table_name + "/" + directory_path
+    table = ca.table_handle(store_name, table_name)
+    store_name, table_name = table.store_name, table.table_name
+    directory_path = table.managed_path + directory_path
     request = {"DataStoreName" : store_name, "TableName" : table_name, "DirectoryPath" : directory_path.lower()}
     items = neuro_call("80", "DataMovementService", "ListDataLakeTableDirectoryItems", request)["Items"]
     return_list = []
@@ -70,12 +76,11 @@ def list_datalake_table_directory_items(store_name: str, table_name: str, direct
 def get_lines_in_datalake_csv(store_name: str, table_name: str, file_name_including_partition: str):
     """
     Get the number of lines for a file in a datalake
+    store_name can be a TableHandle
     """
-    table_def = sm.get_table_definition(store_name, table_name)
-    schema_type = list(sm.SCHEMA_TYPE_MAP.keys())[list(sm.SCHEMA_TYPE_MAP.values()).index(table_def["SchemaType"])]
-    file_path = "/managed/" + schema_type + "/table/" + table_name + "/"
-    file_path = file_path.lower()
-    file_path += file_name_including_partition.strip('/')
+    table = ca.table_handle(store_name, table_name)
+    store_name, table_name = table.store_name, table.table_name
+    file_path = table.file_path(file_name_including_partition)
 
     request = {"DataStoreName" : store_name, "TableName" : table_name, "FilePath" : file_path}
     response = neuro_call("80", "DataMovementService", "GetLinesInDataLakeCsvFile", request)
@@ -100,12 +105,11 @@ def rechunk_datalake_csv(store_name: str, from_table_name: str, file_name_includ
     """
     Split a datalake table's csv file in files with less than 1 million rows.
     This allows to complete files to be streamed through the DataMovement Service.
+    store_name can be a TableHandle for the from table
     """
-    table_def = sm.get_table_definition(store_name, from_table_name)
-    schema_type = list(sm.SCHEMA_TYPE_MAP.keys())[list(sm.SCHEMA_TYPE_MAP.values()).index(table_def["SchemaType"])]
-    file_path = "/managed/" + schema_type + "/table/" + from_table_name + "/"
-    file_path = file_path.lower()
-    file_path += file_name_including_partition.strip('/')
+    table = ca.table_handle(store_name, from_table_name)
+    store_name, from_table_name = table.store_name, table.table_name
+    file_path = table.file_path(file_name_including_partition)
 
     request = {"FromDataStoreName" : store_name, "FromTableName" : from_table_name,
                "FilePath" : file_path, "ToTableName" : to_table_name}
@@ -136,45 +140,164 @@ def rechunk_datalake_csv(store_name: str, from_table_name: str, file_name_includ
 
     return outfiles
 
-def datalake_to_csv(store_name: str, table_name: str, file_name_including_partition: str, file_name: str, data_start_row:str = 2):
+def datalake_to_csv(store_name: str, table_name: str, file_name_including_partition: str, file_name: str, data_start_row:str = 2,
+                    columns: "List[str]" = None, where: str = None):
     """
     Move a file in a datalake into a csv in your notebook environment
+    store_name can be a TableHandle
+    columns: only these columns are written to the csv. Defaults to all the columns in the table.
+    where: a clause to determine whether a row is streamed. Column names can be used to access to the value of the column on that row.
+    ROW and RANDOM are available for use in the where clause.
+    The column selection and where clause are applied by the DataMovementService before the data is sent to the notebook.
     """
     #Get table schema
-    table_def = sm.get_table_definition(store_name, table_name)
-    column_names = []
-    column_types = []
-    table_def["DestinationTableDefinitionColumns"].sort(key=lambda x: x['Index'])
-    for col in table_def["DestinationTableDefinitionColumns"]:
-        column_name = col["ColumnName"]
-        column_data_type = sm.DATA_TYPE_MAP_REV[col['ColumnDataType']]
-        if "String" in column_data_type:
-            column_data_type += "(" + str(col["ColumnDataTypeSize"]) + ")"
-        elif "Decimal" in column_data_type:
-            column_data_type += "(" + str(col["ColumnDataTypePrecision"]) + "," + str(col["ColumnDataTypeScale"]) +")"
-        column_names.append(column_name)
-        column_types.append(column_data_type)
-    source=ss.csv_datalake_source_parameters(store_name,table_name,file_name_including_partition,data_start_row)
-    sink=ss.csv_notebook_sink_parameters(file_name,column_names,column_types)
+    table = ca.table_handle(store_name, table_name)
+    if columns is not None:
+        missing = [col for col in columns if col not in table.column_names]
+        if len(missing) > 0:
+            raise Exception("Columns not in table " + table.table_name + ": " + ", ".join(missing))
+    column_names, column_types = sm.column_names_and_types(table.table_definition, columns)
+    source=ss.csv_datalake_source_parameters(table,None,file_name_including_partition,data_start_row)
+    sink=ss.csv_notebook_sink_parameters(file_name,column_names,column_types,where_clause=where)
     st.stream(source,sink)
     return None
 
-def datalake_to_df(store_name: str, table_name: str, file_name_including_partition: str, data_start_row:str = 2):
+def datalake_to_df(store_name: str, table_name: str, file_name_including_partition: str, data_start_row:str = 2,
+                   columns: "List[str]" = None, where: str = None):
     """
     Load datalake file into a dataframe
+    store_name can be a TableHandle
+    columns and where are pushed down into the stream, see datalake_to_csv
+    Parquet and delta tables are read with datalake_columnar_to_df
     """
-    if not os.path.exists(home_directory()+"/tmp"):
-        os.makedirs(home_directory()+"/tmp")
+    table = ca.table_handle(store_name, table_name)
+    if table.file_type in ["parquet", "delta"]:
+        raise Exception("Table " + table.table_name + " is stored as " + table.file_type +
+                        ", use datalake_columnar_to_df to read it")
 
-    file_name = str(uuid.uuid4()) + ".csv"
+    with temp_file(".csv") as file:
+        datalake_to_csv(table, None,file_name_including_partition, file.notebook_path,data_start_row,
+                        columns=columns, where=where)
+        df = pandas.read_csv(file.path)
+    return df
 
-    count = len(os.getcwd().replace(home_directory(), "").split('/'))-1
+def datalake_columnar_to_df(store_name: str, table_name: str, partition_paths: "List[str]" = None,
+                            columns: "List[str]" = None, where: str = None, limit: int = None, context: str = None):
+    """
+    Load a parquet or delta datalake table into a dataframe without converting it to csv, keeping its column types.
+    store_name can be a TableHandle
+    The table is read in a spark context (defaults to the current context) and returned as Arrow,
+    see neuro_compute.spark_manager.datalake_to_pandas. Delta tables are read through their delta log.
+    partition_paths: partition paths in import_table form eg. ["'/2019/1'"], defaults to the whole table.
+    columns: only these columns are read.
+    where: a spark sql condition eg. "Year = 2019 and Value > 10", pushed down into the parquet or delta scan.
+    """
+    from neuro_python.neuro_compute import spark_manager as spm
+    table = ca.table_handle(store_name, table_name)
+    if table.file_type not in ["parquet", "delta"]:
+        raise Exception("Table file type must be parquet or delta")
+    if columns is not None:
+        missing = [col for col in columns if col not in table.column_names]
+        if len(missing) > 0:
+            raise Exception("Columns not in table " + table.table_name + ": " + ", ".join(missing))
+    return spm.datalake_to_pandas(table.store_name, table.table_name, partition_paths, columns=columns, where=where,
+                                  limit=limit, context=context)
 
-    backs = ""
-    for c in range(0, count):
-        backs += "../"
-    datalake_to_csv(store_name, table_name,file_name_including_partition, backs + "tmp/" + file_name,data_start_row)
+def df_to_datalake(data: "pandas.DataFrame", store_name: str, table_name: str, partition_by: "List[str]" = None,
+                   partition_path: str = "", max_workers: int = 4, max_rows_per_file: int = 1000000,
+                   checkpoint_file: str = None, resume: bool = False):
+    """
+    Upload a dataframe into a datalake table.
+    store_name can be a TableHandle
+    partition_by: columns used to split the dataframe. Each group is written under partition_path/<value>/...
+    Partition columns can't contain null values.
+    The dataframe is split into chunk files of at most max_rows_per_file rows which are written and streamed
+    into the table concurrently, with at most max_workers stream jobs running at a time.
+    checkpoint_file: local file recording the chunks that were uploaded.
+    resume: only upload the chunks not recorded in checkpoint_file. The dataframe and arguments must be the
+    same as the original call.
+    """
+    start = time.time()
 
-    df = pandas.read_csv(home_directory() + "/" + "tmp/" + file_name)
-    os.remove(home_directory() + "/" + "tmp/" + file_name)
-    return df
+    #Validate against the table schema once
+    table = ca.table_handle(store_name, table_name)
+    store_name, table_name, table_def = table.store_name, table.table_name, table.table_definition
+    column_names_types = [pair for pair in zip(table.column_names, table.column_types) if pair[0] != "NeuroverseLastModified"]
+    column_names = [pair[0] for pair in column_names_types]
+    column_types = [pair[1] for pair in column_names_types]
+    missing = [col for col in column_names if col not in data.columns]
+    extra = [col for col in data.columns if col not in column_names]
+    if len(missing) > 0:
+        required = [col["ColumnName"] for col in table_def["DestinationTableDefinitionColumns"] if col["IsRequired"]]
+        missing_required = [col for col in missing if col in required]
+        if len(missing_required) > 0:
+            raise Exception("Required columns missing from dataframe: " + ", ".join(missing_required))
+    if len(extra) > 0:
+        raise Exception("Columns not in table " + table_name + ": " + ", ".join(extra))
+    if partition_by is not None:
+        for col in partition_by:
+            if col not in data.columns:
+                raise Exception("Partition column not in dataframe: " + col)
+            if data[col].isnull().any():
+                raise Exception("Partition column contains null values: " + col)
+
+    table_path = table.managed_path
+
+    #Split by partition and file size
+    if partition_by is None or len(partition_by) == 0:
+        groups = [(partition_path.strip('/'), data)]
+    else:
+        groups = []
+        for keys, frame in data.groupby(partition_by):
+            if not isinstance(keys, tuple):
+                keys = (keys,)
+            path = "/".join([partition_path.strip('/')] + [str(key) for key in keys]).strip('/')
+            groups.append((path, frame))
+    chunks = []
+    for path, frame in groups:
+        for ind in range(0, len(frame), max_rows_per_file):
+            chunks.append((path, ind, frame.iloc[ind:ind + max_rows_per_file]))
+
+    completed = checkpoint.start_checkpoint(checkpoint_file, resume)
+
+    def upload(chunk):
+        path, ind, frame = chunk
+        key = "/" + path + ":" + str(ind)
+        if key in completed:
+            skipped.append(len(frame))
+            return completed[key]
+        frame = frame.reindex(columns=column_names)
+        with temp_file(".csv") as file:
+            frame.to_csv(file.path, index=False)
+            source = {"Type" : "CsvNotebookFileShare", "FileName" : file.path.replace(home_directory() + "/", "", 1),
+                      "Headers" : column_names, "Types" : column_types, "DataStartRow" : 2}
+            sink = {"Type" : "CsvDataLake", "DataStoreName" : store_name, "TableName" : table_name,
+                    "FolderPath" : table_path + path, "Expressions" : None, "WhereClause" : None}
+            result = st.stream(source, sink)
+        checkpoint.mark_completed(checkpoint_file, key, result)
+        return result
+
+    results = []
+    errors = []
+    skipped = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(chunk[0], executor.submit(upload, chunk)) for chunk in chunks]
+        for path, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as err:
+                errors.append("/" + path + ": " + str(err))
+
+    if len(errors) > 0:
+        raise Exception("Neuroverse error: %s of %s files failed to upload\n"%(len(errors), len(chunks)) + "\n".join(errors))
+
+    #Only the chunks streamed by this call are counted, chunks already in the checkpoint are reported as skipped
+    rows = sum([len(chunk[2]) for chunk in chunks]) - sum(skipped)
+    files = len(chunks) - len(skipped)
+    seconds = time.time() - start
+    rows_per_second = rows / seconds if seconds > 0 else 0.0
+    print("Uploaded %s rows in %s files in %.1f seconds (%.0f rows/sec)"%(rows, files, seconds, rows_per_second))
+    if len(skipped) > 0:
+        print("Skipped %s rows in %s files already uploaded"%(sum(skipped), len(skipped)))
+    return {"Jobs" : results, "Rows" : rows, "Files" : files, "SkippedRows" : sum(skipped), "SkippedFiles" : len(skipped),
+            "Seconds" : seconds, "RowsPerSecond" : rows_per_second}
@@ -0,0 +1,371 @@
+"""
+Local evaluation of the sink expression and where clause language.
+Expressions and where clauses are evaluated over a pandas dataframe a column at a time so they can be
+checked, and their selectivity estimated, without running a job in the DataMovementService.
+"""
+
+import os
+import re
+import datetime
+import numpy
+import pandas
+from neuro_python import home_directory
+
+_TOKEN_REGEX = re.compile(r"""
+    (?P<space>\s+)
+   |(?P<number>\d+\.\d*|\.\d+|\d+)
+   |(?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*")
+   |(?P<bracket>\[[^\]]+\])
+   |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+   |(?P<op>&&|\|\||==|!=|<>|<=|>=|[-+*/%<>=!(),])
+""", re.VERBOSE)
+
+_FUNCTIONS = {
+    "ABS" : lambda x: x.abs(),
+    "ROUND" : lambda x, digits=0: x.round(int(_scalar(digits, 0))),
+    "FLOOR" : lambda x: numpy.floor(x),
+    "CEILING" : lambda x: numpy.ceil(x),
+    "LEN" : lambda x: x.astype(str).str.len(),
+    "UPPER" : lambda x: x.astype(str).str.upper(),
+    "LOWER" : lambda x: x.astype(str).str.lower(),
+    "IIF" : lambda condition, a, b: pandas.Series(numpy.where(condition, a, b), index=condition.index),
+    "IF" : lambda condition, a, b: pandas.Series(numpy.where(condition, a, b), index=condition.index),
+    "ISNULL" : lambda x: x.isnull(),
+}
+
+def _scalar(value, default=None):
+    if isinstance(value, pandas.Series):
+        return value.iloc[0] if len(value) > 0 else default
+    return value
+
+def _tokenize(expression: str):
+    tokens = []
+    pos = 0
+    while pos < len(expression):
+        match = _TOKEN_REGEX.match(expression, pos)
+        if match is None:
+            raise Exception("Invalid expression at position %s: %s"%(pos, expression))
+        pos = match.end()
+        kind = match.lastgroup
+        if kind != "space":
+            tokens.append((kind, match.group(kind)))
+    return tokens
+
+class _Parser:
+    """
+    Recursive descent parser that compiles an expression into a function of an evaluation context
+    """
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+
+    def parse(self):
+        node = self._or()
+        if self.pos != len(self.tokens):
+            raise Exception("Unexpected %s in expression: %s"%(self.tokens[self.pos][1], self.expression))
+        return node
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            kind, value = self.tokens[self.pos]
+            if kind == "name" and value.lower() in ["and", "or", "not"]:
+                return value.lower()
+            return value
+        return None
+
+    def _next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def _expect(self, value):
+        if self._peek() != value:
+            raise Exception("Expected %s in expression: %s"%(value, self.expression))
+        self.pos += 1
+
+    def _or(self):
+        node = self._and()
+        while self._peek() in ["||", "or"]:
+            self.pos += 1
+            left, right = node, self._and()
+            node = lambda ctx, left=left, right=right: _bool(left(ctx)) | _bool(right(ctx))
+        return node
+
+    def _and(self):
+        node = self._not()
+        while self._peek() in ["&&", "and"]:
+            self.pos += 1
+            left, right = node, self._not()
+            node = lambda ctx, left=left, right=right: _bool(left(ctx)) & _bool(right(ctx))
+        return node
+
+    def _not(self):
+        if self._peek() in ["!", "not"]:
+            self.pos += 1
+            operand = self._not()
+            return lambda ctx: ~_bool(operand(ctx))
+        return self._comparison()
+
+    def _comparison(self):
+        node = self._additive()
+        op = self._peek()
+        if op in ["=", "==", "!=", "<>", "<", "<=", ">", ">="]:
+            self.pos += 1
+            left, right = node, self._additive()
+            if op in ["=", "=="]:
+                return lambda ctx: left(ctx) == right(ctx)
+            elif op in ["!=", "<>"]:
+                return lambda ctx: left(ctx) != right(ctx)
+            elif op == "<":
+                return lambda ctx: left(ctx) < right(ctx)
+            elif op == "<=":
+                return lambda ctx: left(ctx) <= right(ctx)
+            elif op == ">":
+                return lambda ctx: left(ctx) > right(ctx)
+            else:
+                return lambda ctx: left(ctx) >= right(ctx)
+        return node
+
+    def _additive(self):
+        node = self._term()
+        while self._peek() in ["+", "-"]:
+            op = self._next()[1]
+            left, right = node, self._term()
+            if op == "+":
+                node = lambda ctx, left=left, right=right: left(ctx) + right(ctx)
+            else:
+                node = lambda ctx, left=left, right=right: left(ctx) - right(ctx)
+        return node
+
+    def _term(self):
+        node = self._unary()
+        while self._peek() in ["*", "/", "%"]:
+            op = self._next()[1]
+            left, right = node, self._unary()
+            if op == "*":
+                node = lambda ctx, left=left, right=right: left(ctx) * right(ctx)
+            elif op == "/":
+                node = lambda ctx, left=left, right=right: left(ctx) / right(ctx)
+            else:
+                node = lambda ctx, left=left, right=right: left(ctx) % right(ctx)
+        return node
+
+    def _unary(self):
+        if self._peek() == "-":
+            self.pos += 1
+            operand = self._unary()
+            return lambda ctx: -operand(ctx)
+        if self._peek() == "+":
+            self.pos += 1
+            return self._unary()
+        return self._primary()
+
+    def _primary(self):
+        if self.pos >= len(self.tokens):
+            raise Exception("Unexpected end of expression: " + self.expression)
+        kind, value = self._next()
+        if kind == "number":
+            number = float(value) if "." in value else int(value)
+            return lambda ctx: number
+        if kind == "string":
+            text = value[1:-1].replace(value[0]*2, value[0])
+            return lambda ctx: text
+        if kind == "bracket":
+            column = value[1:-1]
+            return lambda ctx: ctx.column(column)
+        if kind == "op" and value == "(":
+            node = self._or()
+            self._expect(")")
+            return node
+        if kind == "name":
+            upper = value.upper()
+            if self._peek() == "(":
+                if upper not in _FUNCTIONS:
+                    raise Exception("Unknown function %s in expression: %s"%(value, self.expression))
+                self.pos += 1
+                args = []
+                if self._peek() != ")":
+                    args.append(self._or())
+                    while self._peek() == ",":
+                        self.pos += 1
+                        args.append(self._or())
+                self._expect(")")
+                function = _FUNCTIONS[upper]
+                #Only the first argument is broadcast to a series, constants like the digits of ROUND stay scalars
+                return lambda ctx: function(*[ctx.series(arg(ctx)) if ind == 0 else arg(ctx)
+                                              for ind, arg in enumerate(args)])
+            if upper == "ROW":
+                return lambda ctx: ctx.row()
+            if upper == "RANDOM":
+                return lambda ctx: ctx.random()
+            if upper == "TRUE":
+                return lambda ctx: True
+            if upper == "FALSE":
+                return lambda ctx: False
+            if upper == "NULL":
+                return lambda ctx: None
+            return lambda ctx: ctx.column(value)
+        raise Exception("Unexpected %s in expression: %s"%(value, self.expression))
+
+def _bool(value):
+    if isinstance(value, pandas.Series):
+        return value.fillna(False).astype(bool)
+    return bool(value)
+
+class _Context:
+    def __init__(self, df: "pandas.DataFrame", row_offset: int, random_state: "numpy.random.RandomState"):
+        self.df = df
+        self.row_offset = row_offset
+        self.random_state = random_state
+
+    def column(self, name):
+        if name not in self.df.columns:
+            raise Exception("Unknown column: " + name)
+        return self.df[name]
+
+    def row(self):
+        return pandas.Series(numpy.arange(self.row_offset + 1, self.row_offset + len(self.df) + 1), index=self.df.index)
+
+    def random(self):
+        return pandas.Series(self.random_state.random_sample(len(self.df)), index=self.df.index)
+
+    def series(self, value):
+        if isinstance(value, pandas.Series):
+            return value
+        return pandas.Series([value] * len(self.df), index=self.df.index)
+
+_compiled = {}
+
+def compile_expression(expression: str):
+    """
+    Compile an expression or where clause into a function of a dataframe.
+    Compiled expressions are cached.
+    """
+    if expression not in _compiled:
+        _compiled[expression] = _Parser(expression).parse()
+    return _compiled[expression]
+
+def evaluate(df: "pandas.DataFrame", expression: str, row_offset: int = 0, seed: int = None):
+    """
+    Evaluate an expression over every row of a dataframe and return the result as a series.
+    Column names can be used to access the value of the column on that row, [Column Name] for names with spaces.
+    ROW is the 1 based row number (offset by row_offset) and RANDOM is a uniform random number between 0 and 1.
+    """
+    ctx = _Context(df, row_offset, numpy.random.RandomState(seed))
+    return ctx.series(compile_expression(expression)(ctx))
+
+def apply_where(df: "pandas.DataFrame", where_clause: str, row_offset: int = 0, seed: int = None):
+    """
+    Return the rows of a dataframe for which the where clause is true
+    """
+    if where_clause is None or where_clause.strip() == "":
+        return df
+    return df[_bool(evaluate(df, where_clause, row_offset, seed))]
+
+def apply_expressions(df: "pandas.DataFrame", columns: "List[str]", expressions: "List[str]",
+                      row_offset: int = 0, seed: int = None):
+    """
+    Recalculate columns from expressions. expressions must be of equal length to columns.
+    An empty string or None will not recalculate the column.
+    """
+    if expressions is None:
+        return df[columns]
+    if len(expressions) != len(columns):
+        raise Exception("expressions must be of equal length to the column count")
+    output = pandas.DataFrame(index=df.index)
+    for column, expression in zip(columns, expressions):
+        if expression is None or expression == "":
+            output[column] = df[column]
+        else:
+            output[column] = evaluate(df, expression, row_offset, seed)
+    return output
+
+def estimate_selectivity(df: "pandas.DataFrame", where_clause: str, total_rows: int = None, seed: int = None):
+    """
+    Estimate the fraction of rows a where clause keeps from a sample dataframe.
+    total_rows: row count of the full source, used to estimate the output rows.
+    """
+    matched = len(apply_where(df, where_clause, seed=seed))
+    selectivity = matched / len(df) if len(df) > 0 else 0.0
+    if total_rows is None:
+        total_rows = len(df)
+    return {"SampleRows" : len(df), "MatchedRows" : matched, "Selectivity" : selectivity,
+            "EstimatedRows" : int(round(selectivity * total_rows))}
+
+def _dtype(column_data_type: str):
+    if "String" in column_data_type or "Guid" in column_data_type:
+        return str
+    if "Int" in column_data_type:
+        return "Int64"
+    if "Decimal" in column_data_type or "Double" in column_data_type:
+        return float
+    if "Boolean" in column_data_type:
+        return "boolean"
+    return None
+
+def _read_csv_chunks(file_name: str, headers: "List[str]", column_data_types: "List[str]",
+                     data_start_row: int, chunk_size: int):
+    dtypes = {}
+    dates = []
+    for header, data_type in zip(headers, column_data_types):
+        if "DateTime" in data_type:
+            dates.append(header)
+        elif _dtype(data_type) is not None:
+            dtypes[header] = _dtype(data_type)
+    return pandas.read_csv(file_name, header=None, names=headers, skiprows=int(data_start_row) - 1,
+                           dtype=dtypes, parse_dates=dates, chunksize=chunk_size)
+
+def evaluate_csv_source(source: "SourceParameters", where_clause: str = None, chunk_size: int = 100000, seed: int = None):
+    """
+    Evaluate a where clause over a whole csv notebook source (see source_sink.csv_notebook_source_parameters)
+    and report its selectivity
+    """
+    if source["Type"] != "CsvNotebookFileShare":
+        raise Exception("Only CsvNotebookFileShare sources can be evaluated locally")
+    total = 0
+    matched = 0
+    random_state = numpy.random.RandomState(seed)
+    for chunk in _read_csv_chunks(home_directory() + "/" + source["FileName"], source["Headers"], source["Types"],
+                                  source["DataStartRow"], chunk_size):
+        ctx = _Context(chunk, total, random_state)
+        if where_clause is None or where_clause.strip() == "":
+            matched += len(chunk)
+        else:
+            matched += int(_bool(ctx.series(compile_expression(where_clause)(ctx))).sum())
+        total += len(chunk)
+    return {"SampleRows" : total, "MatchedRows" : matched, "Selectivity" : matched / total if total > 0 else 0.0,
+            "EstimatedRows" : matched}
+
+def local_stream(source: "SourceParameters", sink: "SinkParameters", chunk_size: int = 100000, seed: int = None):
+    """
+    Apply a csv notebook sink's expressions and where clause to a csv notebook source locally,
+    appending the result to the sink file without a DataMovementService job.
+    Returns the same JobId and TimeStamp as a stream job, JobId is None, with the Rows read and RowsWritten.
+    """
+    if source["Type"] != "CsvNotebookFileShare" or sink["Type"] != "CsvNotebookFileShare":
+        raise Exception("Only CsvNotebookFileShare sources and sinks can be streamed locally")
+    sink_file_name = home_directory() + "/" + sink["FileName"]
+    write_header = not os.path.isfile(sink_file_name)
+    total = 0
+    written = 0
+    random_state = numpy.random.RandomState(seed)
+    for chunk in _read_csv_chunks(home_directory() + "/" + source["FileName"], source["Headers"], source["Types"],
+                                  source["DataStartRow"], chunk_size):
+        ctx = _Context(chunk, total, random_state)
+        if sink.get("Expressions") is not None:
+            output = pandas.DataFrame(index=chunk.index)
+            for column, expression in zip(sink["Headers"], sink["Expressions"]):
+                if expression is None or expression == "":
+                    output[column] = chunk[column]
+                else:
+                    output[column] = ctx.series(compile_expression(expression)(ctx))
+        else:
+            output = chunk[sink["Headers"]]
+        if sink.get("WhereClause") is not None and sink["WhereClause"].strip() != "":
+            output = output[_bool(ctx.series(compile_expression(sink["WhereClause"])(ctx)))]
+        output.to_csv(sink_file_name, mode="a", header=write_header, index=False)
+        write_header = False
+        total += len(chunk)
+        written += len(output)
+    return {"JobId" : None, "TimeStamp" : datetime.datetime.utcnow().isoformat(), "Rows" : total, "RowsWritten" : written}
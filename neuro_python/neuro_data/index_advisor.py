@@ -0,0 +1,170 @@
+"""
+Recommend indexes for tables in Neuroverse sql data stores from the queries run through neuro_python
+"""
+
+import re
+import json
+import datetime
+import threading
+from neuro_python.neuro_data import schema_manager as sm
+
+_lock = threading.Lock()
+_workload = []
+
+_TABLE_REGEX = re.compile(r"\b(from|join)\s+\[?([A-Za-z_][\w.]*)\]?(?:\s+(?:as\s+)?\[?([A-Za-z_]\w*)\]?)?", re.IGNORECASE)
+_PREDICATE_REGEX = re.compile(r"(?:\[?([A-Za-z_]\w*)\]?\.)?\[?([A-Za-z_]\w*)\]?\s*(?:=|<>|!=|<=|>=|<|>|\bin\s*\(|\bbetween\b|\blike\b|\bis\b)",
+                              re.IGNORECASE)
+_CLAUSE_END_REGEX = re.compile(r"\b(group\s+by|order\s+by|having|union|join|where)\b", re.IGNORECASE)
+_KEYWORDS = {"select", "from", "where", "and", "or", "not", "join", "on", "as", "inner", "left", "right", "outer",
+             "full", "cross", "group", "order", "by", "having", "union", "null", "is", "in", "between", "like", "top"}
+
+def record_query(store_name: str, query: str, seconds: float):
+    """
+    Record a query and how long it took in the workload used for recommendations
+    """
+    with _lock:
+        _workload.append({"StoreName" : store_name, "Query" : query, "Seconds" : seconds,
+                          "RecordedAt" : datetime.datetime.utcnow().isoformat()})
+
+def get_workload(store_name: str = None):
+    """
+    Get the recorded queries
+    """
+    with _lock:
+        return [entry for entry in _workload if store_name is None or entry["StoreName"] == store_name]
+
+def clear_workload():
+    """
+    Remove all recorded queries
+    """
+    with _lock:
+        del _workload[:]
+
+def save_workload(file_name: str):
+    """
+    Save the recorded queries to a file
+    """
+    with open(file_name, "w") as file:
+        file.write(json.dumps(get_workload()))
+
+def load_workload(file_name: str):
+    """
+    Add the queries saved in a file to the recorded queries
+    """
+    with open(file_name) as file:
+        entries = json.loads(file.read())
+    with _lock:
+        _workload.extend(entries)
+
+def _clause(query: str, keyword: str):
+    """
+    Text of every where or on clause in a query
+    """
+    clauses = []
+    for match in re.finditer(r"\b%s\b"%keyword, query, re.IGNORECASE):
+        rest = query[match.end():]
+        end = _CLAUSE_END_REGEX.search(rest)
+        clauses.append(rest[:end.start()] if end is not None else rest)
+    return clauses
+
+def parse_query(query: str):
+    """
+    Find the tables, the columns used in where predicates and the columns used in join clauses of a query
+    """
+    aliases = {}
+    tables = []
+    for match in _TABLE_REGEX.finditer(query):
+        table = match.group(2).split('.')[-1]
+        if table.lower() in _KEYWORDS:
+            continue
+        tables.append(table)
+        aliases[table.lower()] = table
+        if match.group(3) is not None and match.group(3).lower() not in _KEYWORDS:
+            aliases[match.group(3).lower()] = table
+
+    def columns(clauses):
+        found = []
+        for clause in clauses:
+            for match in _PREDICATE_REGEX.finditer(clause):
+                column = match.group(2)
+                if column.lower() in _KEYWORDS:
+                    continue
+                table = aliases.get(match.group(1).lower()) if match.group(1) is not None else None
+                found.append((table, column))
+            #The right hand side of a join equality is also a join column
+            for match in re.finditer(r"=\s*(?:\[?([A-Za-z_]\w*)\]?\.)\[?([A-Za-z_]\w*)\]?", clause):
+                found.append((aliases.get(match.group(1).lower()), match.group(2)))
+        return found
+
+    return {"Tables" : sorted(set(tables)), "PredicateColumns" : columns(_clause(query, "where")),
+            "JoinColumns" : columns(_clause(query, "on"))}
+
+def recommend_indexes(store_name: str, min_queries: int = 2, scan_ratio: float = 0.5):
+    """
+    Recommend indexes for the tables in a sql data store from the recorded workload.
+    A clustered columnstore index is recommended for tables where at least scan_ratio of the queries have no
+    predicate on the table, and nonclustered indexes for columns used in where predicates or join clauses of
+    at least min_queries queries.
+    EstimatedSecondsSaved is a rough estimate from the recorded time of the queries that would use the index.
+    """
+    workload = get_workload(store_name)
+    table_defs = {}
+    usage = {}
+    for entry in workload:
+        parsed = parse_query(entry["Query"])
+        for table in parsed["Tables"]:
+            if table not in table_defs:
+                try:
+                    table_defs[table] = {col["ColumnName"].lower() : col["ColumnName"] for col in
+                                         sm.get_table_definition(store_name, table)["DestinationTableDefinitionColumns"]}
+                except Exception:
+                    table_defs[table] = None
+            if table_defs[table] is None:
+                continue
+            stats = usage.setdefault(table, {"Queries" : 0, "Seconds" : 0.0, "ScanQueries" : 0, "ScanSeconds" : 0.0,
+                                             "Columns" : {}})
+            stats["Queries"] += 1
+            stats["Seconds"] += entry["Seconds"]
+            columns = set()
+            for column_table, column in parsed["PredicateColumns"] + parsed["JoinColumns"]:
+                if column_table not in [None, table]:
+                    continue
+                if column_table is None and len(parsed["Tables"]) > 1 and column.lower() not in table_defs[table]:
+                    continue
+                if column.lower() in table_defs[table]:
+                    columns.add(table_defs[table][column.lower()])
+            if len([c for c in parsed["PredicateColumns"] if c[1].lower() in table_defs[table]]) == 0:
+                stats["ScanQueries"] += 1
+                stats["ScanSeconds"] += entry["Seconds"]
+            for column in columns:
+                column_stats = stats["Columns"].setdefault(column, {"Queries" : 0, "Seconds" : 0.0})
+                column_stats["Queries"] += 1
+                column_stats["Seconds"] += entry["Seconds"]
+
+    recommendations = []
+    for table, stats in usage.items():
+        if stats["ScanQueries"] >= scan_ratio * stats["Queries"] and stats["ScanQueries"] >= min_queries:
+            recommendations.append({"TableName" : table,
+                                    "Index" : sm.index_definition("cci_" + table, "ClusteredColumnStore", []),
+                                    "Reason" : "%s of %s queries scan the table"%(stats["ScanQueries"], stats["Queries"]),
+                                    "Queries" : stats["ScanQueries"],
+                                    "EstimatedSecondsSaved" : 0.5 * stats["ScanSeconds"]})
+        for column, column_stats in stats["Columns"].items():
+            if column_stats["Queries"] >= min_queries:
+                recommendations.append({"TableName" : table,
+                                        "Index" : sm.index_definition("ix_%s_%s"%(table, column), "NonClustered", [column]),
+                                        "Reason" : "%s of %s queries filter or join on %s"%(column_stats["Queries"],
+                                                                                          stats["Queries"], column),
+                                        "Queries" : column_stats["Queries"],
+                                        "EstimatedSecondsSaved" : 0.5 * column_stats["Seconds"]})
+    return sorted(recommendations, key=lambda x: -x["EstimatedSecondsSaved"])
+
+def apply_recommendations(store_name: str, recommendations: "List[dict]"):
+    """
+    Add the recommended indexes to their tables
+    """
+    tables = {}
+    for recommendation in recommendations:
+        tables.setdefault(recommendation["TableName"], []).append(recommendation["Index"])
+    for table_name, indexes in tables.items():
+        sm.add_table_indexes(store_name, table_name, indexes)
@@ -0,0 +1,215 @@
+"""
+Materialised views: SQL view definitions backed by a physical table that is populated through transformation
+"""
+
+import os
+import json
+import datetime
+import threading
+from neuro_python import home_directory
+from neuro_python.neuro_data import schema_manager as sm
+from neuro_python.neuro_data import sql_commands as sc
+
+_lock = threading.Lock()
+_schedules = {}
+
+def _registry_file():
+    return home_directory() + "/.neuro_materialised_views.json"
+
+def _load_registry():
+    if not os.path.isfile(_registry_file()):
+        return {}
+    with _lock:
+        with open(_registry_file()) as file:
+            return json.loads(file.read())
+
+def _update_registry(key: str, entry: dict):
+    with _lock:
+        registry = {}
+        if os.path.isfile(_registry_file()):
+            with open(_registry_file()) as file:
+                registry = json.loads(file.read())
+        if entry is None:
+            registry.pop(key, None)
+        else:
+            registry[key] = entry
+        with open(_registry_file() + ".tmp", "w") as file:
+            file.write(json.dumps(registry, default=str))
+        os.replace(_registry_file() + ".tmp", _registry_file())
+
+def _key(store_name: str, view_name: str):
+    return store_name + "|" + view_name
+
+def source_tables(sql_query: "sql_query"):
+    """
+    Names of the tables a sql query reads from, including the tables in sub queries and joins
+    """
+    tables = []
+    if sql_query["FromTableName"] is not None:
+        tables.append(sql_query["FromTableName"])
+    else:
+        tables += source_tables(sql_query["FromSubQuery"])
+    for join in sql_query["Joins"] or []:
+        if join["JoinTableName"] is not None:
+            tables.append(join["JoinTableName"])
+        else:
+            tables += source_tables(join["JoinSubQuery"])
+    return sorted(set(tables))
+
+def create_materialised_view(store_name: str, view_name: str, sql_query: "sql_query", table_def: "table_definition",
+                             table_name: str = None, incremental: bool = False, watermark_column: str = None,
+                             lookback_seconds: float = None, max_staleness_seconds: float = 3600,
+                             create_sql_view: bool = True):
+    """
+    Create a materialised view. The results of sql_query are stored in a physical table (table_name, defaults to
+    view_name_materialised) defined by table_def, and a plain SQL view is created as well unless create_sql_view is False.
+    incremental: refresh by moving only the new rows, see sql_commands.transformation.
+    max_staleness_seconds: sql_to_df reads from the materialised table instead of the view while the last refresh is
+    more recent than this.
+    Incremental views can't have a group by clause, see sql_commands.transformation.
+    """
+    if incremental and sql_query["GroupByClause"] is not None:
+        raise Exception("Incremental materialised views can't have a group by clause")
+    table_name = table_name or view_name + "_materialised"
+    sm.create_table(store_name, table_name, table_def)
+    if create_sql_view:
+        sm.create_view(store_name, view_name, sc.build_sql(sql_query))
+    _update_registry(_key(store_name, view_name),
+                     {"StoreName" : store_name, "ViewName" : view_name, "TableName" : table_name,
+                      "SqlQuery" : sql_query, "SourceTables" : source_tables(sql_query),
+                      "Incremental" : incremental, "WatermarkColumn" : watermark_column,
+                      "LookbackSeconds" : lookback_seconds, "MaxStalenessSeconds" : max_staleness_seconds,
+                      "LastRefreshed" : None})
+    return refresh_materialised_view(store_name, view_name, full=True)
+
+def list_materialised_views(store_name: str = None):
+    """
+    List materialised views with their tables, source tables and last refresh time
+    """
+    return [entry for entry in _load_registry().values() if store_name is None or entry["StoreName"] == store_name]
+
+def get_materialised_view(store_name: str, view_name: str):
+    """
+    Get a materialised view definition
+    """
+    entry = _load_registry().get(_key(store_name, view_name))
+    if entry is None:
+        raise Exception("Materialised view doesn't exist")
+    return entry
+
+def refresh_materialised_view(store_name: str, view_name: str, full: bool = False):
+    """
+    Refresh a materialised view. Incremental views only move new rows unless full is set,
+    otherwise the table is emptied and repopulated.
+    While rows are being deleted from the table, queries are routed to the view instead of the table.
+    """
+    entry = get_materialised_view(store_name, view_name)
+    refreshed = datetime.datetime.utcnow()
+    if full or not entry["Incremental"] or entry["LookbackSeconds"] is not None:
+        entry["LastRefreshed"] = None
+        _update_registry(_key(store_name, view_name), entry)
+    if entry["Incremental"] and not full:
+        lookback = None
+        if entry["LookbackSeconds"] is not None:
+            lookback = datetime.timedelta(seconds=entry["LookbackSeconds"])
+        response = sc.transformation(store_name, entry["SqlQuery"], entry["TableName"], incremental=True,
+                                     watermark_column=entry["WatermarkColumn"], lookback=lookback)
+    else:
+        sc.delete_rows(store_name, entry["TableName"])
+        if entry["Incremental"]:
+            #Reload everything and move the watermark to the end of the full load
+            sc.reset_watermark(store_name, entry["SqlQuery"], entry["TableName"])
+            response = sc.transformation(store_name, entry["SqlQuery"], entry["TableName"], incremental=True,
+                                         watermark_column=entry["WatermarkColumn"])
+        else:
+            response = sc.transformation(store_name, entry["SqlQuery"], entry["TableName"])
+    entry["LastRefreshed"] = refreshed.isoformat()
+    _update_registry(_key(store_name, view_name), entry)
+    return response
+
+def refresh_dependants(store_name: str, table_name: str):
+    """
+    Refresh every materialised view that reads from a table
+    """
+    views = [entry["ViewName"] for entry in list_materialised_views(store_name) if table_name in entry["SourceTables"]]
+    for view_name in views:
+        refresh_materialised_view(store_name, view_name)
+    return views
+
+def schedule_refresh(store_name: str, view_name: str, interval_seconds: float):
+    """
+    Refresh a materialised view every interval_seconds in a background thread until stop_refresh is called
+    """
+    stop_refresh(store_name, view_name)
+    stop = threading.Event()
+    def work():
+        while not stop.wait(interval_seconds):
+            try:
+                refresh_materialised_view(store_name, view_name)
+            except Exception as err:
+                print("Refresh of materialised view %s failed: %s"%(view_name, str(err)))
+    thread = threading.Thread(target=work, daemon=True)
+    _schedules[_key(store_name, view_name)] = stop
+    thread.start()
+
+def stop_refresh(store_name: str, view_name: str):
+    """
+    Stop the scheduled refresh of a materialised view
+    """
+    stop = _schedules.pop(_key(store_name, view_name), None)
+    if stop is not None:
+        stop.set()
+
+def delete_materialised_view(store_name: str, view_name: str, delete_sql_view: bool = True):
+    """
+    Delete a materialised view and its table
+    """
+    entry = get_materialised_view(store_name, view_name)
+    stop_refresh(store_name, view_name)
+    sm.delete_processed_table(store_name, entry["TableName"])
+    if delete_sql_view:
+        sm.delete_view(store_name, view_name)
+    _update_registry(_key(store_name, view_name), None)
+
+def _fresh_table(entry: dict):
+    if entry["LastRefreshed"] is None:
+        return None
+    age = datetime.datetime.utcnow() - datetime.datetime.fromisoformat(entry["LastRefreshed"])
+    if age.total_seconds() <= entry["MaxStalenessSeconds"]:
+        return entry["TableName"]
+    return None
+
+def route_query(store_name: str, sql_query: "sql_query"):
+    """
+    Replace materialised views in a sql query with their tables when they are fresh enough
+    """
+    registry = _load_registry()
+    if len(registry) == 0:
+        return sql_query
+    tables = {}
+    for entry in registry.values():
+        if entry["StoreName"] == store_name:
+            table_name = _fresh_table(entry)
+            if table_name is not None:
+                tables[entry["ViewName"]] = table_name
+    if len(tables) == 0:
+        return sql_query
+
+    def route(query):
+        query = dict(query)
+        if query["FromTableName"] is not None:
+            query["FromTableName"] = tables.get(query["FromTableName"], query["FromTableName"])
+        else:
+            query["FromSubQuery"] = route(query["FromSubQuery"])
+        if query["Joins"] is not None:
+            joins = []
+            for join in query["Joins"]:
+                join = dict(join)
+                if join["JoinTableName"] is not None:
+                    join["JoinTableName"] = tables.get(join["JoinTableName"], join["JoinTableName"])
+                else:
+                    join["JoinSubQuery"] = route(join["JoinSubQuery"])
+                joins.append(join)
+            query["Joins"] = joins
+        return query
+    return route(sql_query)
@@ -0,0 +1,93 @@
+"""
+Pipelines of dependent stream stages in Neuroverse
+"""
+
+from neuro_python import dag
+from neuro_python import checkpoint
+from neuro_python.neuro_data import source_sink as ss
+from neuro_python.neuro_data import stream_table as st
+
+class Pipeline:
+    """
+    A set of stream stages with dependencies.
+    Independent stages run concurrently and a stage starts as soon as the stages it depends on have finished.
+    """
+    def __init__(self, max_workers: int = 4, retries: int = 0):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.stages = {}
+        self.results = {}
+
+    def add_stage(self, name: str, source: "SourceParameters", sink: "SinkParameters", depends_on: "List[str]" = None):
+        """
+        Add a stream stage.
+        source: source parameters, or the name of an upstream stage whose sink is used as this stage's source
+        (see source_sink.sinktosource).
+        depends_on: names of other stages that must finish before this stage starts.
+        """
+        if name in self.stages:
+            raise Exception("Stage already exists: " + name)
+        depends_on = list(depends_on or [])
+        if isinstance(source, str) and source not in depends_on:
+            depends_on.append(source)
+        self.stages[name] = {"Source" : source, "Sink" : sink, "DependsOn" : depends_on}
+        return self
+
+    def _dependencies(self):
+        return {name : stage["DependsOn"] for name, stage in self.stages.items()}
+
+    def _task(self, name):
+        stage = self.stages[name]
+        def task(inputs):
+            source = stage["Source"]
+            if isinstance(source, str):
+                source = ss.sinktosource(self.stages[source]["Sink"], inputs[source])
+            return st.stream(source, stage["Sink"])
+        return task
+
+    def run(self, max_workers: int = None, retries: int = None, checkpoint_file: str = None, resume: bool = False):
+        """
+        Run the stages that have not yet succeeded. Stages that succeeded in an earlier run are not run again,
+        so calling run again after a failure only retries the failed and skipped stages.
+        checkpoint_file: local file recording the stages that completed, with their JobIds.
+        resume: skip the stages recorded as completed in checkpoint_file, eg. after a kernel restart.
+        """
+        completed = checkpoint.start_checkpoint(checkpoint_file, resume)
+        for name, result in completed.items():
+            if name in self.stages and name not in self.results:
+                self.results[name] = {"Status" : "Succeeded", "Result" : result, "Error" : None,
+                                      "Start" : None, "End" : None, "Seconds" : 0.0, "Attempts" : 0}
+
+        def task_with_checkpoint(name):
+            task = self._task(name)
+            def run_task(inputs):
+                result = task(inputs)
+                checkpoint.mark_completed(checkpoint_file, name, result)
+                return result
+            return run_task
+
+        tasks = {name : task_with_checkpoint(name) for name in self.stages}
+        self.results = dag.run_dag(tasks, self._dependencies(),
+                                   max_workers=max_workers or self.max_workers,
+                                   completed=self.results,
+                                   retries=self.retries if retries is None else retries)
+        failed = [name for name, result in self.results.items() if result["Status"] == "Failed"]
+        if len(failed) > 0:
+            raise Exception("Neuroverse error: pipeline stages failed\n" +
+                            "\n".join([name + ": " + str(self.results[name]["Error"]) for name in failed]))
+        return self.results
+
+    def timings(self):
+        """
+        Status, attempts and duration of each stage
+        """
+        return [{"Stage" : name, "Status" : result["Status"], "Attempts" : result.get("Attempts"),
+                 "Seconds" : result["Seconds"]} for name, result in self.results.items()]
+
+    def critical_path(self):
+        """
+        The chain of dependent stages with the longest total duration in the last run
+        """
+        path, seconds = dag.critical_path(self._dependencies(),
+                                          {name : result["Seconds"] for name, result in self.results.items()})
+        return {"Stages" : path, "Seconds" : seconds}
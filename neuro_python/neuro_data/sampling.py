@@ -0,0 +1,98 @@
+"""
+Sample rows from large Neuroverse tables without moving the whole table
+"""
+
+import math
+import random
+from concurrent.futures import ThreadPoolExecutor
+import pandas
+from neuro_python.neuro_data import catalog as ca
+from neuro_python.neuro_data import datalake_commands as dc
+from neuro_python.neuro_data import sql_commands as sc
+from neuro_python.neuro_data.datastore_manager import DataStoreType
+
+def sample_table(store_name: str, table_name: str, n: int = None, fraction: float = None,
+                 stratify_by_partition: bool = True, max_files: int = 20, max_workers: int = 4):
+    """
+    Load a random sample of a table into a dataframe. Either n (number of rows) or fraction (0 to 1) must be supplied.
+    Sql tables are sampled with TABLESAMPLE, oversampling for n and trimming to n random rows.
+    Datalake tables are sampled by selecting up to max_files files, and csv rows are then thinned using RANDOM in
+    the sink where clause so only the sample is moved to the notebook.
+    A fraction that needs more than max_files files raises an exception rather than returning a smaller sample.
+    Only csv datalake tables are supported, parquet and delta tables can be sampled in spark with
+    datalake_commands.datalake_columnar_to_df and a where clause using rand().
+    stratify_by_partition: select files from every partition in proportion to the number of files it holds.
+    """
+    if (n is None) == (fraction is None):
+        raise Exception("Either n or fraction must be supplied")
+    if fraction is not None and not 0 < fraction <= 1:
+        raise Exception("fraction must be between 0 and 1")
+
+    data_store = ca.lookup_data_store(store_name)
+
+    if data_store.get("DataStoreTypeId") == DataStoreType.Sql.value:
+        return _sample_sql_table(store_name, table_name, n, fraction)
+    return _sample_datalake_table(store_name, table_name, n, fraction, stratify_by_partition, max_files, max_workers)
+
+def _sample_sql_table(store_name: str, table_name: str, n: int = None, fraction: float = None):
+    if n is not None:
+        #tablesample picks whole pages so it can return fewer rows than asked for, oversample then trim
+        query = "select top (%s) * from [%s] tablesample (%s rows) order by newid()"%(int(n), table_name, 2 * int(n))
+    else:
+        query = "select * from [%s] tablesample (%s percent)"%(table_name, fraction * 100)
+    return sc.run_sql(store_name, query, return_df=True)
+
+def _select_files(files: "List[str]", count: int, stratify_by_partition: bool):
+    """
+    Randomly select count files, spread over the partitions when stratify_by_partition is set.
+    When there are more partitions than count, count partitions are chosen and one file is taken from each.
+    """
+    if count >= len(files):
+        return list(files)
+    if not stratify_by_partition:
+        return random.sample(files, count)
+    partitions = {}
+    for file in files:
+        partitions.setdefault(file.rsplit('/', 1)[0], []).append(file)
+    if len(partitions) >= count:
+        return [random.choice(partition_files) for partition_files in random.sample(list(partitions.values()), count)]
+    selected = []
+    for partition_files in partitions.values():
+        partition_count = max(1, int(round(count * len(partition_files) / len(files))))
+        selected += random.sample(partition_files, min(partition_count, len(partition_files)))
+    if len(selected) > count:
+        selected = random.sample(selected, count)
+    return selected
+
+def _sample_datalake_table(store_name: str, table_name: str, n: int, fraction: float,
+                           stratify_by_partition: bool, max_files: int, max_workers: int):
+    table = ca.TableHandle(store_name, table_name)
+    if table.file_type != "csv":
+        raise Exception("Only csv datalake tables can be sampled, use datalake_commands.datalake_columnar_to_df for "
+                        + table.file_type + " tables")
+    files = dc.list_datalake_table_files_with_partitions(table, None)
+    files = [file for file in files if '/_' not in file and not file.endswith('/')]
+    if len(files) == 0:
+        raise Exception("Table has no files")
+
+    if fraction is not None:
+        file_count = max(1, int(math.ceil(fraction * len(files))))
+        if file_count > max_files:
+            raise Exception("A fraction of %s needs %s of the %s files in the table, more than max_files (%s)"
+                            %(fraction, file_count, len(files), max_files))
+    else:
+        file_count = max_files
+    selected = _select_files(files, file_count, stratify_by_partition)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if fraction is not None:
+            where = "RANDOM < %s"%(fraction * len(files) / len(selected))
+        else:
+            lines = list(executor.map(lambda file: dc.get_lines_in_datalake_csv(table, None, file), selected))
+            where = "RANDOM < %s"%min(1.0, 1.1 * n / max(1, sum(lines)))
+        frames = list(executor.map(lambda file: dc.datalake_to_df(table, None, file, where=where), selected))
+
+    df = pandas.concat(frames, ignore_index=True)
+    if n is not None and len(df) > n:
+        df = df.sample(n=n)
+    return df.reset_index(drop=True)
@@ -3,8 +3,15 @@ The schema_manager module provides functions to interact with the
 Schema Manager in Neuroverse
 """
 
+import os
+import uuid
 import typing
 import json
+import decimal
+import datetime
+import numpy
+import pandas
+from neuro_python import dag
 from neuro_python.neuro_call import neuro_call
 
 DATA_TYPE_MAP = {"Int" : 11, "Decimal" : 9, "String" : 14, "BigInt" : 1, "Boolean" : 3,
@@ -12,9 +19,12 @@ DATA_TYPE_MAP = {"Int" : 11, "Decimal" : 9, "String" : 14, "BigInt" : 1, "Boolea
                  "Guid" : 22, "VarBinary" : 23}
 DATA_TYPE_MAP_REV = {3 : "Boolean", 11: "Int32", 1 : "Int64", 9 : "Decimal", 10 : "Double", 6 : "DateTime", 22 : "Guid", 14 : "String", 23 : "VarBinary"}
 COL_TYPE_MAP = {"Key" : 1, "Value" : 4, "TimeStampKey" : 3, "ForeignKey" : 2}
+COL_TYPE_MAP_REV = {1 : "Key", 4 : "Value", 3 : "TimeStampKey", 2 : "ForeignKey"}
 SCHEMA_TYPE_MAP = {"DataIngestion" : 1, "TimeSeries" : 2, "Processed" : 3}
 SCHEMA_TYPE_MAP_REV = {1:"DataIngestion", 2:"TimeSeries", 3:"Processed"}
 INDEX_TYPE_MAP = {"NonClustered" : 0, "Clustered" : 1, "ClusteredColumnStore" : 2, "NonClusteredColumnStore" : 3}
+FILE_TYPE_MAP = {"csv" : 0, "parquet" : 1, "avro" : 2, "delta" : 3}
+FILE_TYPE_MAP_REV = {0 : "csv", 1 : "parquet", 2 : "avro", 3 : "delta"}
 
 def get_column_data_types():
     "Get available data types for columns in Neuroverse tabular data"
@@ -119,6 +129,134 @@ def table_definition(columns: "List[table_column]", schema_type: str,
             "DestinationTableName" : "", "DataStoreId" : None, "SchemaType" : schema_type_id,
             "FilePath" : file_path, "FileType": file_type}
 
+def _column_stats(stats: dict, series: "pandas.Series", sample_size: int):
+    """
+    Update the running type statistics of a column with a chunk of its values
+    """
+    values = series.dropna()
+    stats["HasNulls"] = stats.get("HasNulls", False) or len(values) < len(series)
+    if len(values) == 0:
+        return
+    if pandas.api.types.is_bool_dtype(values):
+        kind = "Boolean"
+    elif pandas.api.types.is_integer_dtype(values):
+        kind = "Int"
+    elif pandas.api.types.is_float_dtype(values):
+        kind = "Int" if bool((values == numpy.floor(values)).all()) and numpy.isfinite(values).all() else "Double"
+        if kind == "Int":
+            stats["FromFloat"] = True
+    elif pandas.api.types.is_datetime64_any_dtype(values):
+        kind = "DateTime"
+    else:
+        if len(values) > sample_size:
+            values = values.sample(sample_size)
+        types = set(type(value) for value in values)
+        if types <= {bool}:
+            kind = "Boolean"
+        elif types <= {int}:
+            kind = "Int"
+        elif types <= {decimal.Decimal}:
+            kind = "Decimal"
+        elif types <= {uuid.UUID}:
+            kind = "Guid"
+        elif types <= {bytes, bytearray}:
+            kind = "VarBinary"
+            stats["Size"] = max(stats.get("Size", 0), int(values.map(len).max()))
+        elif all(issubclass(t, (datetime.datetime, datetime.date)) for t in types):
+            kind = "DateTime"
+        else:
+            kind = "String"
+            stats["Size"] = max(stats.get("Size", 0), int(values.astype(str).str.len().max()))
+    if kind == "Int":
+        stats["Min"] = min(stats.get("Min", 0), int(values.min()))
+        stats["Max"] = max(stats.get("Max", 0), int(values.max()))
+    elif kind == "Decimal":
+        for value in values:
+            sign, digits, exponent = value.as_tuple()
+            scale = max(0, -exponent)
+            stats["Scale"] = max(stats.get("Scale", 0), scale)
+            stats["IntegerDigits"] = max(stats.get("IntegerDigits", 1), len(digits) - scale)
+    if stats.get("Kind") is None or stats["Kind"] == kind:
+        stats["Kind"] = kind
+    elif {stats["Kind"], kind} <= {"Int", "Double"}:
+        stats["Kind"] = "Double"
+    elif {stats["Kind"], kind} <= {"Int", "Decimal"}:
+        stats["Kind"] = "Decimal"
+        stats["IntegerDigits"] = max(stats.get("IntegerDigits", 1), len(str(max(abs(stats["Min"]), abs(stats["Max"])))))
+    elif {stats["Kind"], kind} <= {"Int", "Double", "Decimal"}:
+        stats["Kind"] = "Double"
+    else:
+        stats["Kind"] = "String"
+        stats["Size"] = max(stats.get("Size", 0), int(series.dropna().astype(str).str.len().max()))
+
+def _column_data_type(stats: dict):
+    """
+    Narrowest column data type string for the type statistics of a column
+    """
+    kind = stats.get("Kind") or "String"
+    if kind == "Int":
+        if -2**31 <= stats["Min"] and stats["Max"] < 2**31:
+            return "Int32"
+        if -2**63 <= stats["Min"] and stats["Max"] < 2**63:
+            return "Int64"
+        #Too large for Int64, floats stay Double and python ints keep their digits in a Decimal
+        digits = len(str(max(abs(stats["Min"]), abs(stats["Max"]))))
+        if stats.get("FromFloat") or digits > 38:
+            return "Double"
+        return "Decimal(%s,0)"%digits
+    if kind == "Decimal":
+        scale = stats.get("Scale", 0)
+        precision = min(38, stats.get("IntegerDigits", 1) + scale)
+        return "Decimal(%s,%s)"%(precision, min(scale, precision))
+    if kind == "String":
+        #Size 0 is max, nvarchar sizes can't be more than 4000
+        if stats.get("Size", 1) > 4000:
+            return "String(0)"
+        size = 1
+        while size < stats.get("Size", 1):
+            size *= 2
+        return "String(%s)"%min(size, 4000)
+    if kind == "VarBinary":
+        if stats.get("Size", 0) > 8000:
+            return "VarBinary(0)"
+        return "VarBinary(%s)"%stats.get("Size", 0)
+    return kind
+
+def infer_table_definition(data: "pandas.DataFrame", schema_type: str, key_columns: "List[str]" = None,
+                           sample_size: int = 100000, chunk_size: int = 1000000, **kwargs):
+    """
+    Infer a table definition from a dataframe, or an iterable of dataframes (eg. pandas.read_csv with chunksize).
+    The narrowest data type is picked for each column: Int32 or Int64 from the value range, Decimal precision and
+    scale from the values, and String sizes from the longest of up to sample_size sampled values per chunk,
+    rounded up to a power of 2. Strings longer than 4000 and binary values longer than 8000 get size 0 (max).
+    Large dataframes are scanned chunk_size rows at a time.
+    Other arguments are passed on to table_definition, eg. partition_path and file_type.
+    """
+    key_columns = key_columns or []
+    if isinstance(data, pandas.DataFrame):
+        chunks = (data.iloc[ind:ind + chunk_size] for ind in range(0, max(1, len(data)), chunk_size))
+    else:
+        chunks = data
+    stats = None
+    names = None
+    for chunk in chunks:
+        if stats is None:
+            names = list(chunk.columns)
+            stats = {name : {} for name in names}
+        for name in names:
+            _column_stats(stats[name], chunk[name], sample_size)
+    if stats is None:
+        raise Exception("No data to infer a table definition from")
+    for name in key_columns:
+        if name not in stats:
+            raise Exception("Key column not in data: " + name)
+
+    columns = []
+    for name in names:
+        column_type = "Key" if name in key_columns else "Value"
+        columns.append(column_definition(str(name), _column_data_type(stats[name]), column_type, name in key_columns))
+    return table_definition(columns, schema_type, **kwargs)
+
 def create_table(store_name: str, table_name: str, table_def: "table_definition"):
     """
     Create a table in a Neuroverse data store
@@ -127,14 +265,30 @@ def create_table(store_name: str, table_name: str, table_def: "table_definition"
     if len(data_stores["DataStores"]) == 0:
         raise Exception("Data Store name is not valid")
 
+    table_def1 = _create_table_request(table_def)
+    table_def1["DataStoreId"] = data_stores["DataStores"][0]["DataStoreId"]
+    table_def1["DestinationTableName"] = table_name
+
+    neuro_call("80", "datapopulation", "CreateDestinationTableDefinition", table_def1)
+    _invalidate_catalog(store_name, table_name)
+
+def _invalidate_catalog(store_name: str, table_name: str):
+    #The catalog imports this module so it is imported here
+    from neuro_python.neuro_data import catalog as ca
+    ca.invalidate(store_name, table_name)
+
+def _create_table_request(table_def: "table_definition"):
+    """
+    Rebuild a table definition, eg. one loaded from a file, into a create table request
+    """
     columns = []
     for col in table_def["DestinationTableDefinitionColumns"]:
         if col["ColumnName"] != "NeuroverseLastModified":
             column_name = col["ColumnName"]
-            column_type = list(COL_TYPE_MAP.keys())[list(COL_TYPE_MAP.values()).index(col["ColumnType"])]
+            column_type = COL_TYPE_MAP_REV[col["ColumnType"]]
             if "ForeignKey" in column_type:
                 column_type += "(" + col["ForeignKeyTableName"] + "," + col["ForeignKeyColumnName"] + ")"
-            column_data_type = str(list(DATA_TYPE_MAP.keys())[list(DATA_TYPE_MAP.values()).index(col["ColumnDataType"])])
+            column_data_type = DATA_TYPE_MAP_REV[col["ColumnDataType"]]
             if "String" in column_data_type:
                 column_data_type += "(" + str(col["ColumnDataTypeSize"]) + ")"
             elif "VarBinary" in column_data_type:
@@ -146,7 +300,7 @@ def create_table(store_name: str, table_name: str, table_def: "table_definition"
                 column_data_type += "(" + str(col["ColumnDataTypePrecision"]) + "," + str(col["ColumnDataTypeScale"]) +")"
             is_required = col["IsRequired"]
             columns.append(column_definition(column_name, column_data_type, column_type, is_required))
-    schema_type = list(SCHEMA_TYPE_MAP.keys())[list(SCHEMA_TYPE_MAP.values()).index(table_def["SchemaType"])]
+    schema_type = SCHEMA_TYPE_MAP_REV[table_def["SchemaType"]]
     allow_data_changes = table_def["AllowDataLossChanges"]
 
     partition_path = ''
@@ -154,29 +308,67 @@ def create_table(store_name: str, table_name: str, table_def: "table_definition"
         path_list = table_def["FilePath"].split('/')
         partition_path = '/'.join(path_list[5:len(path_list)])
 
-    file_type=table_def['FileType']    
+    file_type=table_def['FileType']
     if file_type is not None:
-        if file_type == 0:
-            file_type="csv"
-        elif file_type == 1:
-            file_type="parquet"
-        elif file_type ==2:
-            file_type='avro'
-        elif file_type ==3:
-            file_type='delta'
-        else:
+        if file_type not in FILE_TYPE_MAP_REV:
             raise Exception("Only csv,parquet,avro and delta file types are supported")
-            
-    table_def1 = table_definition(columns,schema_type,allow_data_changes,partition_path,file_type=file_type)
+        file_type=FILE_TYPE_MAP_REV[file_type]
 
-    table_def1["DataStoreId"] = data_stores["DataStores"][0]["DataStoreId"]
-    table_def1["DestinationTableName"] = table_name
+    return table_definition(columns,schema_type,allow_data_changes,partition_path,file_type=file_type)
 
-    neuro_call("80", "datapopulation", "CreateDestinationTableDefinition", table_def1)
+def create_tables_from_directory(store_name: str, path: str, max_workers: int = 8):
+    """
+    Create a table for every table definition file (.json) in a directory, see save_table_definition.
+    The table name is the definition's DestinationTableName, or the file name without the extension.
+    All definitions are validated before any table is created. Tables are created concurrently, tables
+    referenced by foreign keys in the directory being created before the tables that reference them.
+    """
+    data_stores = neuro_call("80", "datastoremanager", "GetDataStores", {"StoreName" : store_name})
+    if len(data_stores["DataStores"]) == 0:
+        raise Exception("Data Store name is not valid")
+    data_store_id = data_stores["DataStores"][0]["DataStoreId"]
 
-def get_table_definition(store_name: str, table_name: str):
+    requests = {}
+    errors = []
+    for file_name in sorted(os.listdir(path)):
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            table_def = load_table_definition(os.path.join(path, file_name))
+            table_name = table_def.get("DestinationTableName") or file_name[:-len(".json")]
+            request = _create_table_request(table_def)
+        except Exception as err:
+            errors.append(file_name + ": " + str(err))
+            continue
+        if table_name in requests:
+            errors.append(file_name + ": duplicate table name " + table_name)
+            continue
+        request["DataStoreId"] = data_store_id
+        request["DestinationTableName"] = table_name
+        requests[table_name] = request
+    if len(errors) > 0:
+        raise Exception("Invalid table definitions\n" + "\n".join(errors))
+
+    dependencies = {}
+    for table_name, request in requests.items():
+        dependencies[table_name] = sorted(set(col["ForeignKeyTableName"] for col in request["DestinationTableDefinitionColumns"]
+                                              if col["ForeignKeyTableName"] in requests and col["ForeignKeyTableName"] != table_name))
+
+    def task(table_name):
+        return lambda inputs: neuro_call("80", "datapopulation", "CreateDestinationTableDefinition", requests[table_name])
+    results = dag.run_dag({table_name : task(table_name) for table_name in requests}, dependencies, max_workers=max_workers)
+
+    failed = [table_name for table_name, result in results.items() if result["Status"] != "Succeeded"]
+    if len(failed) > 0:
+        raise Exception("Neuroverse error: %s of %s tables were not created\n"%(len(failed), len(requests)) +
+                        "\n".join([table_name + ": " + str(results[table_name]["Error"]) for table_name in failed]))
+    return sorted(requests.keys())
+
+def get_table_definition(store_name: str, table_name: str, include_indexes: bool = False):
     """
     Get an existing table definition for a table in a Neuroverse data store
+    include_indexes: keep the table's existing indexes, they are removed by default so the definition can be
+    sent back without recreating them
     """
     data_stores = neuro_call("80", "datastoremanager", "GetDataStores", {"StoreName" : store_name})["DataStores"]
     if len(data_stores) == 0:
@@ -187,11 +379,32 @@ def get_table_definition(store_name: str, table_name: str):
         raise Exception("Table doesn't exist")
     table_def = table_defs["DestinationTableDefinitions"][0]
 
-    table_def["DestinationTableDefinitionIndexes"] = []
+    if not include_indexes or table_def.get("DestinationTableDefinitionIndexes") is None:
+        table_def["DestinationTableDefinitionIndexes"] = []
     
     table_def['DestinationTableDefinitionColumns'].sort(key=lambda y: y['Index'] )
     return table_def
   
+def column_names_and_types(table_def: "table_definition", columns: "List[str]" = None):
+    """
+    Ordered column names and data type strings of a table definition for csv source and sink parameters
+    """
+    column_names = []
+    column_types = []
+    table_def["DestinationTableDefinitionColumns"].sort(key=lambda x: x['Index'])
+    for col in table_def["DestinationTableDefinitionColumns"]:
+        if columns is not None and col["ColumnName"] not in columns:
+            continue
+        column_name = col["ColumnName"]
+        column_data_type = DATA_TYPE_MAP_REV[col['ColumnDataType']]
+        if "String" in column_data_type:
+            column_data_type += "(" + str(col["ColumnDataTypeSize"]) + ")"
+        elif "Decimal" in column_data_type:
+            column_data_type += "(" + str(col["ColumnDataTypePrecision"]) + "," + str(col["ColumnDataTypeScale"]) +")"
+        column_names.append(column_name)
+        column_types.append(column_data_type)
+    return column_names, column_types
+
 def list_tables(store_name: str, table_name: str='', schema_type: str=''):
     """
     List existing tables in a Neuroverse data store
@@ -204,6 +417,124 @@ def list_tables(store_name: str, table_name: str='', schema_type: str=''):
     
     return [{'TableId':table['TableId'],'TableName':table['TableName'],'SchemaType':SCHEMA_TYPE_MAP_REV[table['TableTypeId']]} for table in table_defs['TableInfos']]
     
+def _column_change(current: "column_definition", desired: "column_definition"):
+    """
+    Classify the change between two definitions of a column as None, "Widened", "WidenedRewrite" or "Changed"
+    """
+    if current["ColumnType"] != desired["ColumnType"] or current["IsRequired"] != desired["IsRequired"] or \
+       current.get("ForeignKeyTableName") != desired.get("ForeignKeyTableName") or \
+       current.get("ForeignKeyColumnName") != desired.get("ForeignKeyColumnName"):
+        return "Changed"
+    current_type = DATA_TYPE_MAP_REV[current["ColumnDataType"]]
+    desired_type = DATA_TYPE_MAP_REV[desired["ColumnDataType"]]
+    if current_type == desired_type:
+        if current_type in ["String", "VarBinary"]:
+            current_size = current["ColumnDataTypeSize"] or 0
+            desired_size = desired["ColumnDataTypeSize"] or 0
+            if current_size == desired_size:
+                return None
+            #A size of 0 is the max size
+            if current_size != 0 and (desired_size == 0 or desired_size > current_size):
+                return "Widened"
+            return "Changed"
+        if current_type == "Decimal":
+            current_scale = current["ColumnDataTypeScale"] or 0
+            desired_scale = desired["ColumnDataTypeScale"] or 0
+            current_digits = (current["ColumnDataTypePrecision"] or 0) - current_scale
+            desired_digits = (desired["ColumnDataTypePrecision"] or 0) - desired_scale
+            if current_scale == desired_scale and current_digits == desired_digits:
+                return None
+            if desired_scale >= current_scale and desired_digits >= current_digits:
+                return "WidenedRewrite"
+            return "Changed"
+        return None
+    if current_type == "Int32" and desired_type in ["Int64", "Double"]:
+        return "WidenedRewrite"
+    if current_type == "Int64" and desired_type == "Double":
+        return "WidenedRewrite"
+    return "Changed"
+
+def diff_table_definition(current: "table_definition", desired: "table_definition"):
+    """
+    Compute the changes needed to turn the current table definition into the desired one.
+    WidenedColumns only need a metadata change, eg. a longer String.
+    RequiresRewrite is set when existing data has to be rewritten, eg. Int32 to Int64 or a wider Decimal.
+    DataLoss is set when columns are removed or changed in a way that can lose data.
+    Indexes in the desired definition that are not in the current definition by name are AddedIndexes,
+    so current must be fetched with get_table_definition(..., include_indexes=True).
+    """
+    def user_columns(table_def):
+        return {col["ColumnName"] : col for col in table_def["DestinationTableDefinitionColumns"]
+                if col["ColumnName"] != "NeuroverseLastModified" and not col.get("IsSystemColumn")
+                and not col.get("WasRemoved")}
+    current_columns = user_columns(current)
+    desired_columns = user_columns(desired)
+
+    added = [name for name in desired_columns if name not in current_columns]
+    removed = [name for name in current_columns if name not in desired_columns]
+    widened = []
+    widened_rewrite = []
+    changed = []
+    for name in desired_columns:
+        if name in current_columns:
+            change = _column_change(current_columns[name], desired_columns[name])
+            if change == "Widened":
+                widened.append(name)
+            elif change == "WidenedRewrite":
+                widened_rewrite.append(name)
+            elif change == "Changed":
+                changed.append(name)
+    required_added = [name for name in added if desired_columns[name]["IsRequired"]]
+
+    current_indexes = [index["IndexName"] for index in current.get("DestinationTableDefinitionIndexes") or []]
+    added_indexes = [index for index in desired.get("DestinationTableDefinitionIndexes") or []
+                     if index["IndexName"] not in current_indexes]
+
+    return {"AddedColumns" : added, "RemovedColumns" : removed, "WidenedColumns" : widened + widened_rewrite,
+            "ChangedColumns" : changed, "AddedIndexes" : added_indexes,
+            "RequiresRewrite" : len(widened_rewrite) + len(changed) + len(required_added) > 0,
+            "DataLoss" : len(removed) + len(changed) > 0,
+            "HasChanges" : len(added) + len(removed) + len(widened) + len(widened_rewrite) + len(changed) + len(added_indexes) > 0}
+
+def apply_table_definition(store_name: str, table_name: str, desired: "table_definition",
+                           allow_rewrite: bool = False, allow_data_loss: bool = False):
+    """
+    Update a table to match the desired table definition, pushing only the changes found by diff_table_definition.
+    Changes that rewrite existing data or can lose data are only applied when allow_rewrite or allow_data_loss are set.
+    Returns the diff that was applied.
+    """
+    current = get_table_definition(store_name, table_name, include_indexes=True)
+    diff = diff_table_definition(current, desired)
+    if not diff["HasChanges"]:
+        return diff
+    if diff["DataLoss"] and not allow_data_loss:
+        raise Exception("Changes can lose data, set allow_data_loss to apply them: " +
+                        ", ".join(diff["RemovedColumns"] + diff["ChangedColumns"]))
+    if diff["RequiresRewrite"] and not allow_rewrite:
+        raise Exception("Changes require the table data to be rewritten, set allow_rewrite to apply them")
+
+    desired_columns = {col["ColumnName"] : col for col in desired["DestinationTableDefinitionColumns"]}
+    for col in current["DestinationTableDefinitionColumns"]:
+        name = col["ColumnName"]
+        if name in diff["RemovedColumns"]:
+            col["WasRemoved"] = True
+        elif name in diff["WidenedColumns"] or name in diff["ChangedColumns"]:
+            for field in ["ColumnType", "IsRequired", "ColumnDataType", "ColumnDataTypeSize",
+                          "ColumnDataTypePrecision", "ColumnDataTypeScale", "ForeignKeyTableName", "ForeignKeyColumnName"]:
+                col[field] = desired_columns[name][field]
+    index = max([col["Index"] for col in current["DestinationTableDefinitionColumns"]] + [-1]) + 1
+    for name in diff["AddedColumns"]:
+        col = dict(desired_columns[name])
+        col["Index"] = index
+        index += 1
+        current["DestinationTableDefinitionColumns"].append(col)
+    current["DestinationTableDefinitionIndexes"] = diff["AddedIndexes"]
+    current["AllowDataLossChanges"] = diff["RequiresRewrite"] or diff["DataLoss"]
+
+    neuro_call("80", "datapopulation", "UpdateDestinationTableDefinition", current)
+    _invalidate_catalog(store_name, table_name)
+    return diff
+
 def add_table_indexes(store_name: str, table_name: str, table_indexes: "List[index_definition]"):
     """
     Add indexes to a table in a Neuroverse SQL data store
@@ -211,6 +542,7 @@ def add_table_indexes(store_name: str, table_name: str, table_indexes: "List[ind
     table_def = get_table_definition(store_name, table_name)
     table_def["DestinationTableDefinitionIndexes"] = table_indexes
     neuro_call("80", "datapopulation", "UpdateDestinationTableDefinition", table_def)
+    _invalidate_catalog(store_name, table_name)
 
 def save_table_definition(file_name: str, table_def: "table_definition"):
     """
@@ -268,6 +600,7 @@ def delete_processed_table(store_name: str, table_name: str, force=True):
             raise Exception("Table schema type is not processed")
         neuro_call("80", "datapopulation", "DeleteDestinationTableDefinition",
                    {"DestinationTableDefinitionId" : table_def["DestinationTableDefinitionId"]})
+        _invalidate_catalog(store_name, table_name)
         print('Table is deleted')
     else:
         print('Table is not deleted')
@@ -4,7 +4,7 @@ Tabular source and sink parameter constructors
 
 import os
 from neuro_python import home_directory
-from neuro_python.neuro_data import schema_manager as sm
+from neuro_python.neuro_data import catalog as ca
 
 def sinktosource(sink, response):
     """
@@ -94,12 +94,11 @@ def csv_datalake_source_parameters(store_name: str, table_name: str, file_name_i
     """
     Source file from datalake
     The datalake tables are partitioned into files. The files can be found through
+    store_name can be a TableHandle
     """
-    table_def = sm.get_table_definition(store_name, table_name)
-    schema_type = list(sm.SCHEMA_TYPE_MAP.keys())[list(sm.SCHEMA_TYPE_MAP.values()).index(table_def["SchemaType"])]
-    file_path = "/managed/" + schema_type + "/table/" + table_name + "/"
-    file_path = file_path.lower()
-    file_path += file_name_including_partition.strip('/')
+    table = ca.table_handle(store_name, table_name)
+    store_name, table_name = table.store_name, table.table_name
+    file_path = table.file_path(file_name_including_partition)
     return {"Type" : "CsvDataLake", "DataStoreName" : store_name, "TableName" : table_name,
             "FileName" : file_path, "DataStartRow" : data_start_row}
 
@@ -108,12 +107,11 @@ def csv_datalake_sink_parameters(store_name: str, table_name: str, partition_pat
     """
     Define a datalake sink.
     A new file will be generated under the partition path
+    store_name can be a TableHandle
     """
-    table_def = sm.get_table_definition(store_name, table_name)
-    schema_type = list(sm.SCHEMA_TYPE_MAP.keys())[list(sm.SCHEMA_TYPE_MAP.values()).index(table_def["SchemaType"])]
-    folder_path = "/managed/" + schema_type + "/table/" + table_name + "/"
-    folder_path = folder_path.lower()
-    folder_path += partition_path.strip('/')
+    table = ca.table_handle(store_name, table_name)
+    store_name, table_name = table.store_name, table.table_name
+    folder_path = table.file_path(partition_path)
 
     return {"Type" : "CsvDataLake", "DataStoreName" : store_name, "TableName" : table_name, "FolderPath" : folder_path,
             "Expressions" : expressions, "WhereClause" : where_clause}
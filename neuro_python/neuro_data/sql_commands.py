@@ -4,20 +4,39 @@ Helper sql commands
 
 import time
 import os
-import uuid
+import json
+import hashlib
 import pandas
 import pyodbc
 from neuro_python import home_directory
+from neuro_python import checkpoint
 from neuro_python.neuro_call import neuro_call
+from neuro_python.temp_storage import temp_file
+from neuro_python.neuro_data import schema_manager as sm
+from neuro_python.neuro_data import catalog as ca
+from neuro_python.neuro_data import index_advisor as ia
 import sqlalchemy as db
 
 from IPython.core import magic_arguments
 from IPython.core.magic import line_magic, cell_magic, line_cell_magic, Magics, magics_class
 
-def transformation(store_name: str, sql_query: "sql_query", sink_table_name: str):
+def transformation(store_name: str, sql_query: "sql_query", sink_table_name: str, incremental: bool = False,
+                   watermark_column: str = None, lookback = None, watermark_file: str = None):
     """
     Execute a sql query on a database and store the results in another table in the same database
+    incremental: only move the rows with a watermark_column value greater than the watermark saved by the
+    last incremental run of the same query into the same sink table.
+    watermark_column: a monotonically increasing column of the query's table. Defaults to the TimeStampKey column.
+    lookback: also move rows this far behind the saved watermark to pick up late arriving data,
+    a datetime.timedelta for datetime columns or a number for numeric columns. The sink rows in the lookback
+    window are deleted before they are moved again, so the sink table must have a watermark_column column.
+    Incremental transformations can't have a group by clause, a slice of the source would write partial groups.
+    watermark_file: local file the watermarks are saved in. Defaults to .neuro_watermarks.json in the home directory.
     """
+    if incremental:
+        return _incremental_transformation(store_name, sql_query, sink_table_name, watermark_column, lookback,
+                                           watermark_file)
+    start = time.time()
     request = {"SqlTransformationParameters" : {"DataStoreName" : store_name, "SqlQuery" : sql_query},
                "SinkTableName" : sink_table_name}
     response = neuro_call("80", "DataMovementService", "SqlTransformation", request)
@@ -37,12 +56,158 @@ def transformation(store_name: str, sql_query: "sql_query", sink_table_name: str
     if status != 1:
         raise Exception("Neuroverse error: " + errormsg)
 
+    ia.record_query(store_name, build_sql(sql_query), time.time() - start)
     return {"JobId" : response["JobId"], "TimeStamp" : response["TimeStamp"]}
 
-def delete_rows(store_name: str, table_name: str, where_clause: str = None):
+def _watermark_key(store_name: str, sql_query: "sql_query", sink_table_name: str):
+    query_hash = hashlib.md5(json.dumps(sql_query, sort_keys=True, default=str).encode()).hexdigest()
+    return store_name + "|" + sink_table_name + "|" + query_hash
+
+def get_watermark(store_name: str, sql_query: "sql_query", sink_table_name: str, watermark_file: str = None):
+    """
+    Get the watermark saved by the last incremental transformation of a query into a sink table
+    """
+    watermark_file = watermark_file or home_directory() + "/.neuro_watermarks.json"
+    entry = checkpoint.load_checkpoint(watermark_file)["Completed"].get(_watermark_key(store_name, sql_query, sink_table_name))
+    if entry is None:
+        return None
+    if entry["WatermarkType"] == "datetime":
+        return pandas.Timestamp(entry["Watermark"])
+    return entry["Watermark"]
+
+def reset_watermark(store_name: str, sql_query: "sql_query", sink_table_name: str, watermark_file: str = None):
+    """
+    Remove the saved watermark so the next incremental transformation moves all rows
+    """
+    watermark_file = watermark_file or home_directory() + "/.neuro_watermarks.json"
+    saved = checkpoint.load_checkpoint(watermark_file)
+    if saved["Completed"].pop(_watermark_key(store_name, sql_query, sink_table_name), None) is not None:
+        checkpoint.save_checkpoint(watermark_file, saved)
+
+def _incremental_transformation(store_name: str, sql_query: "sql_query", sink_table_name: str,
+                                watermark_column: str, lookback, watermark_file: str):
+    if sql_query["FromTableName"] is None:
+        raise Exception("Incremental transformations require a query on a table, not a sub query")
+    if sql_query["GroupByClause"] is not None:
+        raise Exception("Incremental transformations can't have a group by clause")
+    watermark_file = watermark_file or home_directory() + "/.neuro_watermarks.json"
+
+    if watermark_column is None:
+        table_def = ca.lookup_table_definition(store_name, sql_query["FromTableName"])
+        timestamp_columns = [col["ColumnName"] for col in table_def["DestinationTableDefinitionColumns"]
+                             if col["ColumnType"] == sm.COL_TYPE_MAP["TimeStampKey"]]
+        if len(timestamp_columns) == 0:
+            raise Exception("Table has no TimeStampKey column, watermark_column must be supplied")
+        watermark_column = timestamp_columns[0]
+    if sql_query["FromAlias"] is not None:
+        column = "[%s].[%s]"%(sql_query["FromAlias"], watermark_column)
+    else:
+        column = "[%s]"%watermark_column
+
+    #Fix the upper bound before moving so rows inserted during the run are picked up next time
+    bound_query = dict(sql_query)
+    bound_query["SelectClause"] = "max(%s) as Watermark"%column
+    bound_query["GroupByClause"] = None
+    bound_query["HavingClause"] = None
+    bound_query["OrderByClause"] = None
+    upper = run_sql(store_name, build_sql(bound_query), return_df=True)["Watermark"][0]
+    if pandas.isnull(upper):
+        return None
+
+    lower = get_watermark(store_name, sql_query, sink_table_name, watermark_file)
+    if lower is not None and lookback is not None:
+        saved = lower
+        lower = lower - lookback
+        #Remove the rows already moved in the lookback window so they aren't inserted twice
+        sink_columns = [col["ColumnName"] for col in
+                        ca.lookup_table_definition(store_name, sink_table_name)["DestinationTableDefinitionColumns"]]
+        if watermark_column not in sink_columns:
+            raise Exception("Sink table has no " + watermark_column + " column, lookback can't be used")
+        delete_rows(store_name, sink_table_name, "[%s] > %s and [%s] <= %s"%(watermark_column, sql_literal(lower),
+                                                                            watermark_column, sql_literal(saved)))
+    predicate = "%s <= %s"%(column, sql_literal(upper))
+    if lower is not None:
+        predicate = "%s > %s and "%(column, sql_literal(lower)) + predicate
+
+    incremental_query = dict(sql_query)
+    if sql_query["WhereClause"] is not None:
+        incremental_query["WhereClause"] = "(" + sql_query["WhereClause"] + ") and " + predicate
+    else:
+        incremental_query["WhereClause"] = predicate
+
+    response = transformation(store_name, incremental_query, sink_table_name)
+
+    if hasattr(upper, "isoformat"):
+        watermark = {"Watermark" : upper.isoformat(), "WatermarkType" : "datetime"}
+    else:
+        watermark = {"Watermark" : upper.item() if hasattr(upper, "item") else upper, "WatermarkType" : "number"}
+    watermark.update(response)
+    checkpoint.mark_completed(watermark_file, _watermark_key(store_name, sql_query, sink_table_name), watermark)
+    return response
+
+def delete_rows(store_name: str, table_name: str, where_clause: str = None, batch_size: int = None,
+                key_column: str = None, throttle_seconds: float = 1.0, checkpoint_file: str = None,
+                resume: bool = False, truncate_partitions: bool = False):
     """
     Delete rows of a sql table using a where clause. If no where clause is supplied all rows are deleted
+    batch_size: delete in chunks of about this many rows ordered by key_column (defaults to the table's first Key
+    column) so each delete is a small transaction, sleeping throttle_seconds between chunks.
+    checkpoint_file: local file recording the last key deleted, resume=True continues from it.
+    truncate_partitions: truncate the table when there is no where clause, and truncate the partitions of a
+    partitioned table whose rows all match the where clause, before deleting the remaining rows.
     """
+    if truncate_partitions:
+        if where_clause is None:
+            run_sql(store_name, "truncate table [%s]"%table_name)
+            return None
+        _truncate_matching_partitions(store_name, table_name, where_clause)
+
+    if batch_size is None:
+        _delete_rows_job(store_name, table_name, where_clause)
+        return None
+
+    if key_column is None:
+        table_def = ca.lookup_table_definition(store_name, table_name)
+        key_columns = [col["ColumnName"] for col in table_def["DestinationTableDefinitionColumns"]
+                       if col["ColumnType"] == sm.COL_TYPE_MAP["Key"]]
+        if len(key_columns) == 0:
+            raise Exception("Table has no Key column, key_column must be supplied")
+        key_column = key_columns[0]
+
+    completed = checkpoint.start_checkpoint(checkpoint_file, resume)
+    where = "(" + where_clause + ")" if where_clause is not None else "1=1"
+    if "LastKey" in completed:
+        where += " and [%s] > %s"%(key_column, completed["LastKey"]["Key"])
+
+    query = ("select [{0}] as Boundary from (select [{0}], row_number() over (order by [{0}]) as RowNumber " +
+             "from [{1}] where {2}) t where RowNumber % {3} = 0 order by [{0}]").format(
+                 key_column, table_name, where, int(batch_size))
+    bounds = [sql_literal(bound) for bound in run_sql(store_name, query, return_df=True)["Boundary"]]
+
+    batches = len(bounds) + 1
+    lower = None
+    for ind in range(0, batches):
+        batch_where = where
+        if lower is not None:
+            batch_where += " and [%s] > %s"%(key_column, lower)
+        if ind < len(bounds):
+            batch_where += " and [%s] <= %s"%(key_column, bounds[ind])
+        else:
+            #Last batch also removes rows with a null key
+            batch_where = where
+            if lower is not None:
+                batch_where += " and ([%s] > %s or [%s] is null)"%(key_column, lower, key_column)
+        start = time.time()
+        response = _delete_rows_job(store_name, table_name, batch_where)
+        print("Deleted batch %s of %s in %.1f seconds"%(ind + 1, batches, time.time() - start))
+        if ind < len(bounds):
+            lower = bounds[ind]
+            checkpoint.mark_completed(checkpoint_file, "LastKey", {"Key" : lower, "JobId" : response["JobId"],
+                                                                    "TimeStamp" : response["TimeStamp"]})
+            time.sleep(throttle_seconds)
+    return None
+
+def _delete_rows_job(store_name: str, table_name: str, where_clause: str = None):
     request = {"DataStoreName" : store_name, "TableName" : table_name,
                "WhereClause" : where_clause}
     response = neuro_call("80", "DataMovementService", "SqlDelete", request)
@@ -62,7 +227,29 @@ def delete_rows(store_name: str, table_name: str, where_clause: str = None):
     if status != 1:
         raise Exception("Neuroverse error: " + errormsg)
 
-    return None
+    return {"JobId" : response["JobId"], "TimeStamp" : response["TimeStamp"]}
+
+def _truncate_matching_partitions(store_name: str, table_name: str, where_clause: str):
+    """
+    Truncate the partitions of a partitioned table in which every row matches the where clause
+    """
+    query = ("select top 1 pf.name as FunctionName, c.name as ColumnName from sys.indexes i " +
+             "join sys.partition_schemes ps on ps.data_space_id = i.data_space_id " +
+             "join sys.partition_functions pf on pf.function_id = ps.function_id " +
+             "join sys.index_columns ic on ic.object_id = i.object_id and ic.index_id = i.index_id and ic.partition_ordinal = 1 " +
+             "join sys.columns c on c.object_id = ic.object_id and c.column_id = ic.column_id " +
+             "where i.object_id = object_id('%s') and i.index_id in (0, 1)")%table_name.replace("'", "''")
+    partitioning = run_sql(store_name, query, return_df=True)
+    if len(partitioning) == 0:
+        return []
+    partition = "$partition.[%s]([%s])"%(partitioning["FunctionName"][0], partitioning["ColumnName"][0])
+    query = ("select %s as PartitionNumber from [%s] group by %s " +
+             "having count(*) = sum(case when (%s) then 1 else 0 end)")%(partition, table_name, partition, where_clause)
+    partitions = [int(p) for p in run_sql(store_name, query, return_df=True)["PartitionNumber"]]
+    if len(partitions) > 0:
+        run_sql(store_name, "truncate table [%s] with (partitions (%s))"%(table_name, ", ".join(map(str, partitions))))
+        print("Truncated %s partitions"%len(partitions))
+    return partitions
 
 def sql_to_csv(store_name: str, sql_query: "sql_query", file_name: str):
     """
@@ -107,6 +294,25 @@ def sql_to_csv(store_name: str, sql_query: "sql_query", file_name: str):
 
     return None
 
+def sql_literal(value):
+    """
+    Format a python value as a sql literal
+    """
+    if value is None:
+        return "null"
+    #numpy scalars, eg. from read_sql, are converted first as numpy.float64 is a float with a numpy repr
+    if hasattr(value, "item") and not hasattr(value, "isoformat"):
+        return sql_literal(value.item())
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if hasattr(value, "isoformat") and hasattr(value, "hour"):
+        return "cast('" + value.isoformat() + "' as datetime2)"
+    if hasattr(value, "isoformat"):
+        value = value.isoformat()
+    return "'" + str(value).replace("'", "''") + "'"
+
 def build_sql(sql_query: "sql_query"):
     query=''
     query+='select '+sql_query['SelectClause']
@@ -142,9 +348,13 @@ def build_sql(sql_query: "sql_query"):
 def sql_to_df(store_name: str, sql_query: "sql_query",use_pyodbc=True):
     """
     Execute a sql query and have the result put into a pandas dataframe in the notebook
+    Materialised views in the query are read from their tables when they are fresh enough
     """
+    from neuro_python.neuro_data import materialised_view as mv
+    sql_query = mv.route_query(store_name, sql_query)
+    start = time.time()
     if use_pyodbc:
-        connstrbits=neuro_call('80','datastoremanager','GetDataStores',{'StoreName':store_name})['DataStores'][0]['ConnectionString'].split(';')
+        connstrbits=ca.lookup_data_store(store_name, include_connection_string=True)['ConnectionString'].split(';')
         server=connstrbits[0].split(':')[1].split(',')[0]
         database=connstrbits[1].split('=')[1]
         username=connstrbits[2].split('=')[1]
@@ -152,25 +362,16 @@ def sql_to_df(store_name: str, sql_query: "sql_query",use_pyodbc=True):
         driver= '{ODBC Driver 13 for SQL Server}'
         with pyodbc.connect('DRIVER='+driver+';SERVER='+server+';PORT=1433;DATABASE='+database+';UID='+username+';PWD='+ password) as cnxn:
             with cnxn.cursor() as cursor:
-                return pandas.read_sql(build_sql(sql_query),cnxn)
+                df = pandas.read_sql(build_sql(sql_query),cnxn)
     else:
-        if not os.path.exists(home_directory()+"/tmp"):
-            os.makedirs(home_directory()+"/tmp")
-
-        file_name = str(uuid.uuid4()) + ".csv"
-
-        count = len(os.getcwd().replace(home_directory(), "").split('/'))-1
-
-        backs = ""
-        for c in range(0, count):
-            backs += "../"
-        sql_to_csv(store_name, sql_query, backs + "tmp/" + file_name)
+        with temp_file(".csv") as file:
+            sql_to_csv(store_name, sql_query, file.notebook_path)
+            df = pandas.read_csv(file.path)
+    ia.record_query(store_name, build_sql(sql_query), time.time() - start)
+    return df
 
-        df = pandas.read_csv(home_directory() + "/" + "tmp/" + file_name)
-        os.remove(home_directory() + "/" + "tmp/" + file_name)
-        return df
 def df_to_sql(store_name: str,table_name: str, data: "pandas.DataFrame"):
-    connstrbits=neuro_call('80','datastoremanager','GetDataStores',{'StoreName':store_name})['DataStores'][0]['ConnectionString'].split(';')
+    connstrbits=ca.lookup_data_store(store_name, include_connection_string=True)['ConnectionString'].split(';')
     server=connstrbits[0].split(':')[1].split(',')[0]
     database=connstrbits[1].split('=')[1]
     domain=server.split('.')[0]
@@ -184,7 +385,7 @@ def run_sql(store_name: str, sql_query: str, return_df=False):
     """
     Execute a sql query and have the result put into a pandas dataframe in the notebook
     """
-    connstrbits=neuro_call('80','datastoremanager','GetDataStores',{'StoreName':store_name})['DataStores'][0]['ConnectionString'].split(';')
+    connstrbits=ca.lookup_data_store(store_name, include_connection_string=True)['ConnectionString'].split(';')
     server=connstrbits[0].split(':')[1].split(',')[0]
     database=connstrbits[1].split('=')[1]
     username=connstrbits[2].split('=')[1]
@@ -217,10 +418,12 @@ class SqlMagics(Magics):
         if storename==None:
             raise Exception('Data store name must be provided')
         out=args.out
+        start=time.time()
         if cell.strip().lower().startswith('select'):
             df=run_sql(storename,cell.replace('\n',' '),return_df=True)
         else:
             df=run_sql(storename,cell.replace('\n',' '))
+        ia.record_query(storename,cell.replace('\n',' '),time.time()-start)
         if out!=None:
             self.shell.user_ns[out]=df
         else:
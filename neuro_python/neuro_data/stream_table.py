@@ -3,12 +3,68 @@ Stream tabular data from a source to sink in Neuroverse
 """
 
 import time
+from concurrent.futures import ThreadPoolExecutor
+from neuro_python import checkpoint
 from neuro_python.neuro_call import neuro_call
+from neuro_python.neuro_data import sql_commands as sc
+from neuro_python.neuro_data import expression_evaluator as ee
 
-def stream(source: "SourceParameters", sink: "SinkParameters"):
+def stream(source: "SourceParameters", sink: "SinkParameters", parallelism: int = 1, split_column: str = None,
+           checkpoint_file: str = None, resume: bool = False, local: bool = False):
     """
     Stream data from a tabular data source to a tabular data sink
+    parallelism: number of concurrent jobs to split the stream into.
+    A sql source is split into ranges of split_column with roughly equal row counts.
+    A datalake source is split into the files under its file name, which is treated as a partition path.
+    The jobs run as one logical stream, all failures are reported together once every job has finished.
+    checkpoint_file: local file recording the completed jobs of the stream, split or not.
+    resume: only run the jobs not recorded as completed in checkpoint_file. The split must be the same as the
+    original call, ie. the same source, parallelism and split_column.
+    local: apply the sink expressions and where clause in the notebook for CsvNotebookFileShare to
+    CsvNotebookFileShare streams instead of running a DataMovementService job (see expression_evaluator).
+    A local stream can't be split or checkpointed, its result has a JobId of None and the row counts.
     """
+    if local:
+        if parallelism > 1 or split_column is not None or checkpoint_file is not None or resume:
+            raise Exception("parallelism, split_column, checkpoint_file and resume aren't supported for local streams")
+        return ee.local_stream(source, sink)
+
+    if parallelism <= 1:
+        completed = checkpoint.start_checkpoint(checkpoint_file, resume)
+        key = _source_key(source)
+        if key in completed:
+            return completed[key]
+        result = _stream_job(source, sink)
+        checkpoint.mark_completed(checkpoint_file, key, result)
+        return result
+
+    if source["Type"] == "Sql":
+        if split_column is None:
+            raise Exception("split_column must be supplied to split a sql source")
+        sources = _split_sql_source(source, split_column, parallelism)
+    elif source["Type"] == "CsvDataLake":
+        sources = _split_datalake_source(source)
+    else:
+        raise Exception("Source type: " + source["Type"] + " can't be split")
+
+    completed = checkpoint.start_checkpoint(checkpoint_file, resume)
+
+    def run(sub_source):
+        key = _source_key(sub_source)
+        if key in completed:
+            return completed[key]
+        result = _stream_job(sub_source, sink)
+        checkpoint.mark_completed(checkpoint_file, key, result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = [executor.submit(run, sub_source) for sub_source in sources]
+    return _combine_results(sources, futures)
+
+def _source_key(source: "SourceParameters"):
+    return str(source.get("SqlWhereClause") or source.get("FileName"))
+
+def _stream_job(source: "SourceParameters", sink: "SinkParameters"):
     request = {"SourceParameters" : source, "SinkParameters" : sink}
     method = source["Type"] + "To" + sink["Type"]
     response = neuro_call("80", "DataMovementService", method, request)
@@ -29,3 +85,77 @@ def stream(source: "SourceParameters", sink: "SinkParameters"):
         raise Exception("Neuroverse error: " + errormsg)
 
     return {"JobId" : response["JobId"], "TimeStamp" : response["TimeStamp"]}
+
+def _split_sql_source(source: "SourceParameters", split_column: str, parallelism: int):
+    """
+    Split a sql source into where clauses on split_column covering ranges of roughly equal row counts
+    """
+    where = ""
+    if source["SqlWhereClause"] is not None:
+        where = " where " + source["SqlWhereClause"]
+    query = ("select max([{0}]) as UpperBound from (select [{0}], ntile({1}) over (order by [{0}]) as Tile " +
+             "from [{2}]{3}) t where [{0}] is not null group by Tile order by Tile").format(
+                 split_column, int(parallelism), source["TableName"], where)
+    bounds = list(sc.run_sql(source["DataStoreName"], query, return_df=True)["UpperBound"])
+    bounds = [bound for ind, bound in enumerate(bounds) if ind == 0 or bound != bounds[ind-1]]
+
+    clauses = []
+    lower = None
+    for ind, upper in enumerate(bounds):
+        if lower is None:
+            clause = "([%s] <= %s or [%s] is null)"%(split_column, sc.sql_literal(upper), split_column)
+        elif ind == len(bounds) - 1:
+            clause = "[%s] > %s"%(split_column, sc.sql_literal(lower))
+        else:
+            clause = "[%s] > %s and [%s] <= %s"%(split_column, sc.sql_literal(lower), split_column, sc.sql_literal(upper))
+        lower = upper
+        clauses.append(clause)
+    if len(clauses) == 0:
+        clauses = [None]
+
+    sources = []
+    for clause in clauses:
+        sub_source = dict(source)
+        if clause is not None and source["SqlWhereClause"] is not None:
+            clause = "(" + source["SqlWhereClause"] + ") and " + clause
+        elif clause is None:
+            clause = source["SqlWhereClause"]
+        sub_source["SqlWhereClause"] = clause
+        sources.append(sub_source)
+    return sources
+
+def _split_datalake_source(source: "SourceParameters"):
+    """
+    Split a datalake source into a source per file under its file name
+    """
+    table_name = source["TableName"].lower()
+    request = {"DataStoreName" : source["DataStoreName"], "TableName" : source["TableName"]}
+    files = neuro_call("80", "DataMovementService", "ListDataLakeTableFiles", request)["Files"]
+    table_path, prefix = source["FileName"].split(table_name, 1)
+    prefix = prefix.strip('/')
+    sources = []
+    for file in files:
+        file_name = file.split(table_name, 1)[1].strip('/')
+        if (file_name == prefix or file_name.startswith(prefix + "/") or prefix == "") and "/_" not in "/" + file_name:
+            sub_source = dict(source)
+            sub_source["FileName"] = table_path + table_name + "/" + file_name
+            sources.append(sub_source)
+    if len(sources) == 0:
+        raise Exception("No files found under " + source["FileName"])
+    return sources
+
+def _combine_results(sources: "List[SourceParameters]", futures: "List[Future]"):
+    """
+    Combine the results of split stream jobs into one result, raising one error for all failed jobs
+    """
+    jobs = []
+    errors = []
+    for sub_source, future in zip(sources, futures):
+        try:
+            jobs.append(future.result())
+        except Exception as err:
+            errors.append(_source_key(sub_source) + ": " + str(err))
+    if len(errors) > 0:
+        raise Exception("Neuroverse error: %s of %s jobs failed\n"%(len(errors), len(sources)) + "\n".join(errors))
+    return {"JobIds" : [job["JobId"] for job in jobs], "TimeStamp" : min([job["TimeStamp"] for job in jobs]),
+            "Jobs" : jobs}
@@ -0,0 +1,72 @@
+"""
+Temporary storage for the intermediate files created by neuro_python helpers
+"""
+
+import os
+import threading
+import uuid
+import tempfile
+import contextlib
+from neuro_python import home_directory
+
+LOCAL_TEMP_DIRECTORIES = ["/dev/shm", tempfile.gettempdir()]
+
+class TempFile:
+    """
+    A temporary file.
+    path is the absolute path of the file.
+    notebook_path is the path relative to the current working directory that the notebook
+    source and sink parameters expect.
+    """
+    def __init__(self, directory: str, file_name: str):
+        self.path = directory + "/" + file_name
+        self.notebook_path = None
+        if self.path.startswith(home_directory() + "/"):
+            count = len(os.getcwd().replace(home_directory(), "").split('/'))-1
+            self.notebook_path = "../" * count + self.path.replace(home_directory() + "/", "", 1)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+def share_temp_directory():
+    """
+    Temporary directory on the notebook file share. DataMovementService jobs can read and write files here.
+    """
+    directory = home_directory() + "/tmp"
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    return directory
+
+def local_temp_directory():
+    """
+    Temporary directory on local fast storage (tmpfs when available).
+    Falls back to the notebook file share when no local directory is writable.
+    """
+    for directory in LOCAL_TEMP_DIRECTORIES:
+        if os.path.isdir(directory) and os.access(directory, os.W_OK):
+            return directory
+    return share_temp_directory()
+
+def temp_file_name(extension: str = ""):
+    """
+    A file name that is unique across processes and threads
+    """
+    return "%s_%s_%s%s"%(os.getpid(), threading.get_ident(), uuid.uuid4().hex, extension)
+
+@contextlib.contextmanager
+def temp_file(extension: str = "", local: bool = False):
+    """
+    Context manager yielding a TempFile which is removed on exit, including when an exception is raised.
+    local=False puts the file on the notebook file share so it can be used by DataMovementService jobs.
+    local=True puts the file on local fast storage, only use it for files that never leave the notebook.
+    """
+    if local:
+        directory = local_temp_directory()
+    else:
+        directory = share_temp_directory()
+    file = TempFile(directory, temp_file_name(extension))
+    try:
+        yield file
+    finally:
+        file.remove()
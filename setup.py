@@ -4,6 +4,7 @@ import subprocess
 subprocess.check_call(["python", '-m', 'pip', 'install', 'SQLAlchemy==1.3.3']) # install pkg
 subprocess.check_call(["python", '-m', 'pip', 'install', 'scikit-learn==0.21.3']) # install pkg
 subprocess.check_call(["python", '-m', 'pip', 'install', 'retrying==1.3.3']) # install pkg
+subprocess.check_call(["python", '-m', 'pip', 'install', 'pyarrow==1.0.1']) # install pkg
 
 setup(name='neuro_python',
       packages=find_packages())